@@ -1,17 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+import time
+# أزمنة مراحل بدء التشغيل لتقرير --startup-report: [(المرحلة، الثواني)]
+STARTUP_TIMINGS = []
+_startup_clock = time.perf_counter()
+
+def startup_mark(phase):
+    global _startup_clock
+    now = time.perf_counter()
+    STARTUP_TIMINGS.append((phase, now - _startup_clock))
+    _startup_clock = now
+
+from flask import Flask, render_template, request, redirect, url_for, flash, abort
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 from contextlib import contextmanager
 import sys
-from flask import send_file, request
+from flask import send_file, request, Response, g, jsonify, has_request_context, session, make_response
+from flask import stream_with_context
+from flask import before_render_template, template_rendered
 import io
-import xlsxwriter
-try:
-    import openpyxl
-except ImportError:
-    openpyxl = None
-    # Optionally, you can log or print a warning here
+import csv
+import hashlib
+import json
+import re
+import socket
+import tempfile
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from markupsafe import Markup, escape
+# مكتبات إكسل (xlsxwriter و openpyxl) تُستورد عند أول تصدير أو استيراد فقط لتسريع بدء التشغيل
+startup_mark('imports')
 
 # Helper to get resource path (for PyInstaller compatibility)
 def resource_path(relative_path):
@@ -37,148 +59,1336 @@ else:
                 static_folder='static')
 
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+app.config['DATABASE'] = DATABASE
+# إعدادات مجمّع اتصالات قاعدة البيانات
+app.config['DB_POOL_SIZE'] = 8            # أقصى عدد من الاتصالات الخاملة المحتفظ بها
+app.config['DB_POOL_IDLE_TIMEOUT'] = 300  # ثوانٍ قبل إغلاق الاتصال الخامل
+# إعدادات التخزين المطبقة على كل اتصال جديد (WAL يسمح بالقراءة أثناء الكتابة)
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 10000,      # ملي ثانية
+    'cache_size': -16000,       # بالكيلوبايت (قيمة سالبة)
+    'mmap_size': 134217728,     # 128MB
+    'temp_store': 'MEMORY',
+}
+# الكتابة تبدأ بـ BEGIN IMMEDIATE وتنتظر قفل SQLite حتى busy_timeout. طابور الكتابة داخل العملية
+# معطل افتراضياً: في bench_storage.py لم يقلل أخطاء "database is locked" وخفّض معدل الكتابة
+app.config['DB_SERIALIZE_WRITES'] = False
+# قياس أداء الطلبات والاستعلامات (اختياري): SHIPPING_PERF=1 ثم افتح /debug/perf من نفس الجهاز
+app.config['PERF_INSTRUMENTATION'] = os.environ.get('SHIPPING_PERF') == '1'
+# إعدادات خادم الإنتاج (serve.py)، ويمكن تغييرها بمتغيرات البيئة دون تعديل الكود
+app.config['SERVER_HOST'] = os.environ.get('SHIPPING_HOST', '0.0.0.0')
+app.config['SERVER_PORT'] = int(os.environ.get('SHIPPING_PORT', 5000))
+app.config['SERVER_WORKERS'] = int(os.environ.get('SHIPPING_WORKERS', min(os.cpu_count() or 1, 4)))  # عمليات (لينكس فقط)
+app.config['SERVER_THREADS'] = int(os.environ.get('SHIPPING_THREADS', 8))    # خيوط لكل عملية
+app.config['SERVER_KEEPALIVE'] = int(os.environ.get('SHIPPING_KEEPALIVE', 5))  # ثوانٍ لإبقاء الاتصال الخامل مفتوحاً
+app.config['SERVER_TIMEOUT'] = int(os.environ.get('SHIPPING_TIMEOUT', 300))    # أقصى زمن للطلب (التصدير الكامل قد يطول)
+app.config['SERVER_GRACEFUL_TIMEOUT'] = int(os.environ.get('SHIPPING_GRACEFUL_TIMEOUT', 30))  # مهلة إنهاء الطلبات الجارية عند إعادة التشغيل
+app.config['SERVER_MAX_REQUESTS'] = int(os.environ.get('SHIPPING_MAX_REQUESTS', 0))  # إعادة تشغيل العملية بعد N طلب (0 = أبداً)
+# مهام التصدير في الخلفية
+app.config['EXPORT_JOB_WORKERS'] = 2      # عدد ملفات التصدير التي تُبنى في نفس الوقت (لكل عملية)
+app.config['EXPORT_JOB_TTL'] = 3600       # ثوانٍ يبقى فيها الملف الجاهز متاحاً للتنزيل
+app.config['EXPORT_JOB_DIR'] = None       # مجلد الملفات الجاهزة (الافتراضي: exports بجانب قاعدة البيانات)
+app.config['EXPORT_JOB_HEARTBEAT'] = 15   # ثوانٍ بين إشارات "ما زالت تعمل" وتنظيف الملفات المنتهية، ما دامت هناك مهام جارية
+app.config['EXPORT_JOB_STALE_AFTER'] = 120  # مهمة بلا إشارة لهذه المدة تعتبر متوقفة (عملية انتهت أو قُتلت)
+# ذاكرة نتائج التقارير المؤقتة
+app.config['REPORT_CACHE_ENTRIES'] = 32        # أقصى عدد من نتائج التقارير في الذاكرة
+app.config['REPORT_CACHE_MAX_ROWS'] = 200000   # أقصى مجموع للشحنات والبنود المحفوظة في الذاكرة
+app.config['REPORT_CACHE_DIR'] = None          # مجلد اختياري لحفظ النتائج على القرص ومشاركتها بين العمليات
+app.config['REPORT_CACHE_DISK_ENTRIES'] = 256  # أقصى عدد من الملفات في مجلد القرص
 
-def init_db():
+class WriteQueue:
+    """طابور كتابة عادل (FIFO): يخدم طلبات الكتابة واحداً تلو الآخر بترتيب وصولها."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()  # تذاكر خرج أصحابها قبل دورهم (مهلة أو مقاطعة)
+
+    def _advance(self):
+        # يُستدعى والقفل محجوز: ننتقل للتذكرة التالية ونتخطى التذاكر المتروكة
+        self._serving += 1
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+        self._cond.notify_all()
+
+    @contextmanager
+    def turn(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            try:
+                while ticket != self._serving:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise sqlite3.OperationalError('database is locked (write queue timeout)')
+                    self._cond.wait(remaining)
+            except BaseException:
+                # لا نترك التذكرة معلقة حتى لا يتوقف كل من بعدها
+                if ticket == self._serving:
+                    self._advance()
+                else:
+                    self._abandoned.add(ticket)
+                raise
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._advance()
+
+write_queue = WriteQueue()
+
+# التواريخ تُخزَّن نصاً بصيغة ISO موحدة ('YYYY-MM-DD HH:MM:SS') فتبقى قابلة للفهرسة والمقارنة
+# كنصوص، وتُحوَّل تلقائياً إلى datetime عند القراءة من الأعمدة المعرفة بنوع DATETIME
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def convert_datetime(value):
+    try:
+        return datetime.fromisoformat(value.decode())
+    except ValueError:
+        return None
+
+sqlite3.register_converter('DATETIME', convert_datetime)
+sqlite3.register_adapter(datetime, lambda value: value.strftime(DATETIME_FORMAT))
+
+def perf_request():
+    """عدادات قياس الطلب الحالي، أو None إذا كان القياس معطلاً أو لا يوجد طلب."""
+    if not has_request_context():
+        return None
+    return g.get('perf')
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    مؤشر يضيف زمن جلب الصفوف (المرور على المؤشر أو fetch*) إلى زمن الاستعلام الذي أنشأه،
+    لأن SQLite ينفذ معظم العمل أثناء الجلب وليس عند execute.
+    """
+    _perf = None
+    _perf_query = None  # [نص الاستعلام، الزمن بالثواني] في سجل استعلامات الطلب
+
+    def _timed(self, fetch, *args):
+        if self._perf is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._perf['query_time'] += elapsed
+            self._perf_query[1] += elapsed
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """اتصال يقيس زمن كل استعلام (التنفيذ وجلب الصفوف) ضمن الطلب الحالي عند تفعيل قياس الأداء."""
+
+    def _timed(self, method, sql, parameters):
+        perf = perf_request()
+        if perf is None:
+            return getattr(super(), method)(sql, parameters)
+        cursor = self.cursor(InstrumentedCursor)
+        query = [sql, 0.0]
+        perf['queries'] += 1
+        perf['query_log'].append(query)
+        started = time.perf_counter()
+        try:
+            getattr(cursor, method)(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            perf['query_time'] += elapsed
+            query[1] += elapsed
+        cursor._perf = perf
+        cursor._perf_query = query
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self._timed('execute', sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._timed('executemany', sql, parameters)
+
+def _trace_statement(statement):
+    # يُستدعى من SQLite لكل جملة منفذة، بما فيها جمل القوادح وبدء/إنهاء المعاملات
+    perf = perf_request()
+    if perf is not None:
+        perf['statements'] += 1
+
+class ConnectionPool:
+    """
+    مجمّع اتصالات SQLite طويلة العمر: يعيد استخدام الاتصالات بين الطلبات بدل فتح
+    اتصال جديد في كل مرة، مع فحص صلاحية الاتصال وإغلاق الاتصالات الخاملة.
+    """
+
+    def __init__(self, database, max_size=8, idle_timeout=300, pragmas=None):
+        self.database = database
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.pragmas = dict(pragmas or {})
+        self._idle = []  # [(connection, released_at)]
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # الاتصال قد ينتقل بين خيوط الخادم لذلك نعطل فحص الخيط
+        timeout = self.pragmas.get('busy_timeout', 5000) / 1000
+        db = sqlite3.connect(self.database, timeout=timeout, check_same_thread=False,
+                             detect_types=sqlite3.PARSE_DECLTYPES, factory=InstrumentedConnection)
+        if app.config['PERF_INSTRUMENTATION']:
+            db.set_trace_callback(_trace_statement)
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            db.execute(f'PRAGMA {name} = {value}')
+        return db
+
+    def _evict_idle(self, now):
+        expired = [db for db, released_at in self._idle if now - released_at > self.idle_timeout]
+        self._idle = [(db, released_at) for db, released_at in self._idle if now - released_at <= self.idle_timeout]
+        return expired
+
+    def acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = self._evict_idle(now)
+            db = self._idle.pop()[0] if self._idle else None
+        for conn in expired:
+            conn.close()
+        if db is not None:
+            # فحص صلاحية الاتصال قبل تسليمه
+            try:
+                db.execute('SELECT 1').fetchone()
+                return db
+            except sqlite3.Error:
+                try:
+                    db.close()
+                except sqlite3.Error:
+                    pass
+        return self._connect()
+
+    def release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+            db.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            db.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((db, time.monotonic()))
+                return
+        db.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db, _ in idle:
+            db.close()
+
+_pool = None
+_pool_pid = None
+
+def get_pool():
+    """Return the connection pool of the current process (recreated after fork)."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ConnectionPool(app.config['DATABASE'],
+                               max_size=app.config['DB_POOL_SIZE'],
+                               idle_timeout=app.config['DB_POOL_IDLE_TIMEOUT'],
+                               pragmas=app.config['SQLITE_PRAGMAS'])
+        _pool_pid = os.getpid()
+    return _pool
+
+def reset_pool():
+    """Close pooled connections so that the next get_db() picks up changed config."""
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close_all()
+    _pool = None
+
+# ترحيلات المخطط بالترتيب: رقم الترحيل = موقعه في القائمة + 1، ويُحفظ آخر رقم منفذ في
+# PRAGMA user_version حتى ينفذ كل ترحيل مرة واحدة فقط. أي تعديل جديد على المخطط يضاف
+# كترحيل جديد في آخر القائمة ولا تُعدل الترحيلات السابقة.
+MIGRATIONS = []
+MIGRATION_BATCH_SIZE = 5000
+
+def migration(description):
+    def register(func):
+        MIGRATIONS.append((description, func))
+        return func
+    return register
+
+def schema_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate():
+    """
+    تنفيذ الترحيلات التي لم تنفذ بعد، كل ترحيل في معاملة مستقلة مع رفع user_version ضمنها.
+    يعيد [(رقم الترحيل، الوصف، الزمن بالثواني)] للترحيلات المنفذة.
+    """
     with get_db() as db:
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS shipment (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                shopiny_number TEXT UNIQUE NOT NULL,
-                receipt_number TEXT UNIQUE,
-                order_number TEXT,
-                delivery_date DATETIME,
-                from_governorate TEXT NOT NULL,
-                to_governorate TEXT NOT NULL,
-                carrier_company TEXT,
-                notes TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS shipment_type (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL
-            )
-        ''')
-        
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS department (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL
-            )
-        ''')
-        
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS shipment_item (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                shipment_id INTEGER NOT NULL,
-                shipment_type_id INTEGER NOT NULL,
-                department_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL,
-                cost INTEGER NOT NULL,
-                boxes_count INTEGER NOT NULL,
-                total INTEGER NOT NULL,
-                notes TEXT,
-                FOREIGN KEY (shipment_id) REFERENCES shipment (id) ON DELETE CASCADE,
-                FOREIGN KEY (shipment_type_id) REFERENCES shipment_type (id),
-                FOREIGN KEY (department_id) REFERENCES department (id)
-            )
+        current = schema_version(db)
+    results = []
+    for version, (description, func) in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        with get_db(write=True) as db:
+            # قد تكون عملية أخرى نفذت الترحيل أثناء انتظار دور الكتابة
+            if schema_version(db) >= version:
+                continue
+            func(db)
+            db.execute(f'PRAGMA user_version = {version}')
+        results.append((version, description, time.perf_counter() - started))
+    return results
+
+def table_columns(db, table):
+    return {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+
+def copy_rows(db, source, target, columns, where='1=1', batch_size=MIGRATION_BATCH_SIZE):
+    """نسخ الصفوف بين جدولين بجمل INSERT ... SELECT على دفعات حسب نطاقات id."""
+    max_id = db.execute(f'SELECT MAX(id) FROM {source}').fetchone()[0] or 0
+    column_list = ', '.join(columns)
+    copied = 0
+    for start in range(0, max_id, batch_size):
+        copied += db.execute(f"""
+            INSERT INTO {target} ({column_list})
+            SELECT {column_list} FROM {source}
+            WHERE id > ? AND id <= ? AND ({where})
+        """, [start, start + batch_size]).rowcount
+    return copied
+
+@migration('create base tables')
+def _create_base_tables(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS shipment (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shopiny_number TEXT UNIQUE NOT NULL,
+            receipt_number TEXT UNIQUE,
+            order_number TEXT,
+            delivery_date DATETIME,
+            from_governorate TEXT NOT NULL,
+            to_governorate TEXT NOT NULL,
+            carrier_company TEXT,
+            notes TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS shipment_type (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+    ''')
+    
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS department (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+    ''')
+    
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS shipment_item (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shipment_id INTEGER NOT NULL,
+            shipment_type_id INTEGER NOT NULL,
+            department_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            cost INTEGER NOT NULL,
+            boxes_count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            notes TEXT,
+            FOREIGN KEY (shipment_id) REFERENCES shipment (id) ON DELETE CASCADE,
+            FOREIGN KEY (shipment_type_id) REFERENCES shipment_type (id),
+            FOREIGN KEY (department_id) REFERENCES department (id)
+        )
+    ''')
+    
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS carrier_company (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+    ''')
+    
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS governorate (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+    ''')
+
+@migration('unique receipt numbers')
+def _unique_receipt_numbers(db):
+    """
+    قواعد البيانات القديمة بدون قيد UNIQUE على receipt_number (كان upgrade_db.py يعالجها):
+    إعادة بناء جدول الشحنات مع الإبقاء على أول شحنة لكل رقم وصل.
+    """
+    for index in db.execute('PRAGMA index_list(shipment)').fetchall():
+        if index['unique']:
+            columns = [row['name'] for row in db.execute(f"PRAGMA index_info('{index['name']}')")]
+            if columns == ['receipt_number']:
+                return
+    columns = ['id', 'shopiny_number', 'receipt_number', 'order_number', 'delivery_date',
+               'from_governorate', 'to_governorate', 'carrier_company', 'notes', 'created_at']
+    db.execute('DROP TABLE IF EXISTS shipment_new')
+    db.execute('''
+        CREATE TABLE shipment_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shopiny_number TEXT UNIQUE NOT NULL,
+            receipt_number TEXT UNIQUE,
+            order_number TEXT,
+            delivery_date DATETIME,
+            from_governorate TEXT NOT NULL,
+            to_governorate TEXT NOT NULL,
+            carrier_company TEXT,
+            notes TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    db.execute("UPDATE shipment SET receipt_number = NULL WHERE receipt_number = ''")
+    db.execute('''
+        CREATE TEMP TABLE shipment_keep AS
+        SELECT MIN(id) AS id FROM shipment WHERE receipt_number IS NOT NULL GROUP BY receipt_number
+    ''')
+    copy_rows(db, 'shipment', 'shipment_new', columns,
+              where='receipt_number IS NULL OR id IN (SELECT id FROM temp.shipment_keep)')
+    db.execute('DROP TABLE temp.shipment_keep')
+    db.execute('DROP TABLE shipment')
+    db.execute('ALTER TABLE shipment_new RENAME TO shipment')
+
+@migration('shipment_item.use_boxes')
+def _add_use_boxes(db):
+    if 'use_boxes' not in table_columns(db, 'shipment_item'):
+        db.execute('ALTER TABLE shipment_item ADD COLUMN use_boxes INTEGER DEFAULT 0')
+
+@migration('data_version table')
+def _create_data_version(db):
+    # عدّاد نسخ البيانات: يزداد مع كل تعديل على الجدول المعني
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS data_version (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+@migration('monthly_rollup table')
+def _create_monthly_rollup(db):
+    # مجاميع شهرية محسوبة مسبقاً تحدَّث مع كل تعديل على الشحنات
+    rollup_exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'monthly_rollup'").fetchone()
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_rollup (
+            month TEXT NOT NULL,
+            from_governorate TEXT NOT NULL,
+            to_governorate TEXT NOT NULL,
+            carrier_company TEXT NOT NULL,
+            shipment_type_id INTEGER NOT NULL,
+            department_id INTEGER NOT NULL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            boxes INTEGER NOT NULL DEFAULT 0,
+            cost INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, from_governorate, to_governorate, carrier_company,
+                         shipment_type_id, department_id)
+        ) WITHOUT ROWID
+    ''')
+    if not rollup_exists:
+        rebuild_rollup(db)
+
+@migration('receipt_counter table')
+def _create_receipt_counter(db):
+    # آخر رقم تسلسلي لوصل شحن جبال لكل (محافظة، شهر)
+    counter_exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'receipt_counter'").fetchone()
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS receipt_counter (
+            governorate TEXT NOT NULL,
+            month TEXT NOT NULL,
+            last_serial INTEGER NOT NULL,
+            PRIMARY KEY (governorate, month)
+        ) WITHOUT ROWID
+    ''')
+    if not counter_exists:
+        seed_receipt_counters(db)
+
+@migration('shipment item totals')
+def _add_shipment_totals(db):
+    # مجاميع بنود كل شحنة محفوظة في صف الشحنة نفسه
+    missing = [c for c in SHIPMENT_TOTAL_COLUMNS if c not in table_columns(db, 'shipment')]
+    for column in missing:
+        db.execute(f'ALTER TABLE shipment ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+    if missing:
+        refresh_shipment_totals(db)
+
+@migration('normalize shipment dates')
+def _normalize_dates(db):
+    normalize_dates(db)
+
+@migration('shipment lookup ids')
+def _add_shipment_lookup_ids(db):
+    # معرفات المحافظات وشركة النقل (الأسماء النصية تبقى للعرض والتوافق مع الملفات القديمة)
+    missing = [c for c in SHIPMENT_LOOKUP_COLUMNS if f'{c}_id' not in table_columns(db, 'shipment')]
+    for column in missing:
+        db.execute(f'''
+            ALTER TABLE shipment ADD COLUMN {column}_id INTEGER
+            REFERENCES {SHIPMENT_LOOKUP_COLUMNS[column]} (id)
         ''')
-        
+    link_shipment_lookups(db)
+
+@migration('export_job table')
+def _create_export_job(db):
+    # مهام التصدير في الخلفية: حالتها وتقدمها ومسار الملف الجاهز
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS export_job (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            job_key TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            rows_written INTEGER NOT NULL DEFAULT 0,
+            rows_total INTEGER,
+            file_path TEXT,
+            error TEXT,
+            created_at DATETIME NOT NULL,
+            finished_at DATETIME,
+            expires_at DATETIME
+        )
+    ''')
+
+@migration('database identity')
+def _create_app_meta(db):
+    # معرف عشوائي ثابت لهذه القاعدة يميز نتائجها المحفوظة على القرص عن نتائج قاعدة أخرى
+    # لها نفس أرقام النسخ (نسخة احتياطية مستعادة أو ملف منسوخ من فرع آخر)
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    db.execute("INSERT OR IGNORE INTO app_meta (name, value) VALUES ('database_id', ?)", [uuid.uuid4().hex])
+
+@migration('export_job owner and heartbeat')
+def _add_export_job_owner(db):
+    # العملية المنفذة لكل مهمة وآخر إشارة منها، لاكتشاف المهام التي توقفت عمليتها
+    columns = table_columns(db, 'export_job')
+    if 'owner' not in columns:
+        db.execute('ALTER TABLE export_job ADD COLUMN owner TEXT')
+    if 'heartbeat_at' not in columns:
+        db.execute('ALTER TABLE export_job ADD COLUMN heartbeat_at DATETIME')
+
+def database_identity(db):
+    """هوية ملف قاعدة البيانات الحالي: المسار ورقم الملف (inode) والمعرف المحفوظ داخله."""
+    path = os.path.abspath(app.config['DATABASE'])
+    try:
+        inode = os.stat(path).st_ino
+    except OSError:
+        inode = None
+    row = db.execute("SELECT value FROM app_meta WHERE name = 'database_id'").fetchone()
+    return [path, inode, row[0] if row else None]
+
+SEARCH_INDEX_OBJECTS = {'shipment_fts', 'shipment_fts_insert', 'shipment_fts_delete', 'shipment_fts_update'}
+
+def schema_objects_current(db):
+    """هل الفهارس المدارة وفهرس البحث موجودة كما هي معرفة؟ (قراءة واحدة من sqlite_master)"""
+    objects = {row['name']: row['sql'] for row in db.execute('SELECT name, sql FROM sqlite_master')}
+    indexes = {name: sql for name, sql in objects.items() if name.startswith('idx_')}
+    expected = {name: f'CREATE INDEX {name} ON {definition}' for name, definition in MANAGED_INDEXES.items()}
+    return indexes == expected and SEARCH_INDEX_OBJECTS <= objects.keys()
+
+def init_db():
+    for version, description, seconds in migrate():
+        print(f'migration {version} ({description}): {seconds:.3f}s')
+    # عند تطابق المخطط يكفي الاستعلامان السابقان (user_version و sqlite_master) بدون قفل كتابة
+    with get_db() as db:
+        if schema_objects_current(db):
+            return
+    with get_db(write=True) as db:
+        ensure_indexes(db)
+        ensure_search_index(db)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations and report their timings."""
+    results = migrate()
+    for version, description, seconds in results:
+        print(f'migration {version} ({description}): {seconds:.3f}s')
+    with get_db() as db:
+        print(f'schema version {schema_version(db)} of {len(MIGRATIONS)}')
+
+# الفهارس الثانوية التي يديرها التطبيق (الاسم: تعريف الفهرس)
+MANAGED_INDEXES = {
+    'idx_shipment_item_shipment': 'shipment_item (shipment_id)',
+    'idx_shipment_item_type': 'shipment_item (shipment_type_id)',
+    'idx_shipment_item_department': 'shipment_item (department_id)',
+    'idx_shipment_delivery_date': 'shipment (delivery_date)',
+    'idx_shipment_from_gov_id_date': 'shipment (from_governorate_id, delivery_date)',
+    'idx_shipment_to_gov_id': 'shipment (to_governorate_id)',
+    'idx_shipment_carrier_id_date': 'shipment (carrier_company_id, delivery_date)',
+    'idx_shipment_created': 'shipment (created_at, id)',
+    'idx_export_job_key': 'export_job (job_key, status)',
+}
+
+def ensure_indexes(db):
+    """
+    إنشاء الفهارس الناقصة وحذف الفهارس القديمة (idx_*) التي لم تعد ضمن MANAGED_INDEXES،
+    ثم تحديث إحصائيات المخطط إذا تغيّر شيء.
+    """
+    existing = {row['name']: row['sql'] for row in db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx\\_%' ESCAPE '\\'")}
+    changed = False
+    for name in existing:
+        if name not in MANAGED_INDEXES:
+            db.execute(f'DROP INDEX IF EXISTS {name}')
+            changed = True
+    for name, definition in MANAGED_INDEXES.items():
+        sql = f'CREATE INDEX {name} ON {definition}'
+        if existing.get(name) != sql:
+            db.execute(f'DROP INDEX IF EXISTS {name}')
+            db.execute(sql)
+            changed = True
+    if changed:
+        db.execute('ANALYZE')
+
+# يصبح False إذا كانت نسخة SQLite مبنية بدون FTS5، فيعود البحث إلى LIKE
+search_index_enabled = True
+
+def ensure_search_index(db, rebuild=False):
+    """
+    فهرس بحث نصي (FTS5 trigram) على أرقام الشحنة والملاحظات، يبقى متزامناً مع جدول
+    shipment عبر القوادح (triggers).
+    """
+    global search_index_enabled
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'shipment_fts'").fetchone()
+    if not exists:
+        try:
+            db.execute('''
+                CREATE VIRTUAL TABLE shipment_fts USING fts5(
+                    shopiny_number, receipt_number, order_number, notes,
+                    content='shipment', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            search_index_enabled = False
+            return
+        rebuild = True
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS shipment_fts_insert AFTER INSERT ON shipment BEGIN
+            INSERT INTO shipment_fts (rowid, shopiny_number, receipt_number, order_number, notes)
+            VALUES (new.id, new.shopiny_number, new.receipt_number, new.order_number, new.notes);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS shipment_fts_delete AFTER DELETE ON shipment BEGIN
+            INSERT INTO shipment_fts (shipment_fts, rowid, shopiny_number, receipt_number, order_number, notes)
+            VALUES ('delete', old.id, old.shopiny_number, old.receipt_number, old.order_number, old.notes);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS shipment_fts_update
+        AFTER UPDATE OF shopiny_number, receipt_number, order_number, notes ON shipment BEGIN
+            INSERT INTO shipment_fts (shipment_fts, rowid, shopiny_number, receipt_number, order_number, notes)
+            VALUES ('delete', old.id, old.shopiny_number, old.receipt_number, old.order_number, old.notes);
+            INSERT INTO shipment_fts (rowid, shopiny_number, receipt_number, order_number, notes)
+            VALUES (new.id, new.shopiny_number, new.receipt_number, new.order_number, new.notes);
+        END
+    ''')
+    if rebuild:
+        db.execute("INSERT INTO shipment_fts (shipment_fts) VALUES ('rebuild')")
+    search_index_enabled = True
+
+def normalize_dates(db):
+    """
+    توحيد صيغة التواريخ المخزنة (مثل '2025-01-05' أو '2025-01-05T10:00:00') إلى DATETIME_FORMAT.
+    القيم التي لا يفهمها SQLite تبقى كما هي. يعيد عدد الشحنات المعدلة.
+    """
+    changed = 0
+    for column in ('delivery_date', 'created_at'):
+        changed += db.execute(f'''
+            UPDATE shipment SET {column} = strftime('%Y-%m-%d %H:%M:%S', {column})
+            WHERE typeof({column}) = 'text'
+              AND strftime('%Y-%m-%d %H:%M:%S', {column}) IS NOT NULL
+              AND {column} != strftime('%Y-%m-%d %H:%M:%S', {column})
+        ''').rowcount
+    return changed
+
+# أعمدة الشحنة النصية المرتبطة بجداول القوائم: {العمود: الجدول}، ومعرفها في العمود {العمود}_id
+SHIPMENT_LOOKUP_COLUMNS = {
+    'from_governorate': 'governorate',
+    'to_governorate': 'governorate',
+    'carrier_company': 'carrier_company',
+}
+
+def link_shipment_lookups(db):
+    """
+    تعبئة معرفات المحافظات وشركة النقل الفارغة من الأسماء النصية (أصغر معرف عند تكرار الاسم).
+    الشحنات التي لا يوجد اسمها في جدول القائمة تبقى بدون معرف. يعيد عدد التعديلات.
+    """
+    changed = 0
+    for column, table in SHIPMENT_LOOKUP_COLUMNS.items():
+        changed += db.execute(f'''
+            UPDATE shipment SET {column}_id = (SELECT MIN(t.id) FROM {table} t WHERE t.name = shipment.{column})
+            WHERE {column}_id IS NULL AND {column} IN (SELECT name FROM {table})
+        ''').rowcount
+    return changed
+
+def unlink_shipment_lookup(db, table, lookup_id):
+    """فك ارتباط الشحنات بعنصر قائمة محذوف، وربطها بعنصر آخر بنفس الاسم إن وجد."""
+    for column, column_table in SHIPMENT_LOOKUP_COLUMNS.items():
+        if column_table == table:
+            db.execute(f'UPDATE shipment SET {column}_id = NULL WHERE {column}_id = ?', [lookup_id])
+    link_shipment_lookups(db)
+    bump_data_version(db, 'shipment')
+
+def rename_shipment_lookup(db, table, lookup_id, name):
+    """
+    نقل الاسم الجديد لعنصر قائمة إلى الأعمدة النصية في الشحنات المرتبطة به، ونقل صفوف
+    المجاميع الشهرية وعدادات الوصولات (مفتاحها الاسم) من الاسم القديم إلى الجديد.
+    """
+    changed = 0
+    for column, column_table in SHIPMENT_LOOKUP_COLUMNS.items():
+        if column_table != table:
+            continue
+        old_names = [row[0] for row in db.execute(
+            f'SELECT DISTINCT {column} FROM shipment WHERE {column}_id = ? AND {column} IS NOT ?',
+            [lookup_id, name])]
+        if not old_names:
+            continue
+        changed += db.execute(f'UPDATE shipment SET {column} = ? WHERE {column}_id = ? AND {column} IS NOT ?',
+                              [name, lookup_id, name]).rowcount
+        for old_name in old_names:
+            rename_rollup_key(db, column, old_name, name, lookup_id)
+    if changed:
+        bump_data_version(db, 'shipment')
+
+# أعمدة مجاميع البنود في جدول الشحنات
+SHIPMENT_TOTAL_COLUMNS = ('item_count', 'total_quantity', 'total_boxes', 'total_amount')
+
+def refresh_shipment_totals(db, shipment_id=None):
+    """
+    إعادة حساب مجاميع بنود شحنة واحدة (أو كل الشحنات إذا لم يحدد رقم).
+    يُستدعى ضمن معاملة تعديل البنود نفسها حتى لا تختلف المجاميع عن البنود.
+    """
+    where, params = ('WHERE id = ?', [shipment_id]) if shipment_id is not None else ('', [])
+    db.execute(f'''
+        UPDATE shipment SET ({', '.join(SHIPMENT_TOTAL_COLUMNS)}) = (
+            SELECT COUNT(*), COALESCE(SUM(si.quantity), 0), COALESCE(SUM(si.boxes_count), 0),
+                   COALESCE(SUM(CASE WHEN si.use_boxes THEN si.boxes_count ELSE si.quantity END * si.cost), 0)
+            FROM shipment_item si WHERE si.shipment_id = shipment.id
+        )
+        {where}
+    ''', params)
+
+@app.cli.command('refresh-totals')
+def refresh_totals_command():
+    """Recompute the item totals stored on every shipment."""
+    with get_db(write=True) as db:
+        refresh_shipment_totals(db)
+        count = db.execute('SELECT COUNT(*) FROM shipment').fetchone()[0]
+        bump_data_version(db, 'shipment')
+    print(f'shipment totals refreshed: {count} shipments')
+
+# تجميع بنود الشحنات حسب (الشهر، من، إلى، الشركة، الصنف، القسم)
+ROLLUP_SELECT = '''
+    SELECT COALESCE(substr(s.delivery_date, 1, 7), ''), s.from_governorate, s.to_governorate,
+           COALESCE(s.carrier_company, ''), si.shipment_type_id, si.department_id,
+           {sign} * COUNT(*), {sign} * SUM(si.quantity), {sign} * SUM(si.boxes_count),
+           {sign} * SUM(CASE WHEN si.use_boxes THEN si.boxes_count ELSE si.quantity END * si.cost)
+    FROM shipment s
+    JOIN shipment_item si ON si.shipment_id = s.id
+    WHERE {where}
+    GROUP BY 1, 2, 3, 4, 5, 6
+'''
+
+def apply_rollup(db, shipment_id, sign):
+    """
+    إضافة (sign=1) أو طرح (sign=-1) مساهمة شحنة واحدة من جدول monthly_rollup.
+    يُستدعى بـ -1 قبل تعديل/حذف الشحنة أو بنودها وبـ 1 بعد حفظها.
+    """
+    db.execute(f'''
+        INSERT INTO monthly_rollup (month, from_governorate, to_governorate, carrier_company,
+                                    shipment_type_id, department_id, item_count, quantity, boxes, cost)
+        {ROLLUP_SELECT.format(sign=int(sign), where='s.id = ?')}
+        ON CONFLICT (month, from_governorate, to_governorate, carrier_company, shipment_type_id, department_id)
+        DO UPDATE SET item_count = item_count + excluded.item_count,
+                      quantity = quantity + excluded.quantity,
+                      boxes = boxes + excluded.boxes,
+                      cost = cost + excluded.cost
+    ''', [shipment_id])
+    if sign < 0:
         db.execute('''
-            CREATE TABLE IF NOT EXISTS carrier_company (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL
-            )
-        ''')
-        
+            DELETE FROM monthly_rollup
+            WHERE item_count <= 0
+              AND month = (SELECT COALESCE(substr(delivery_date, 1, 7), '') FROM shipment WHERE id = ?)
+        ''', [shipment_id])
+
+ROLLUP_KEY_COLUMNS = ('month', 'from_governorate', 'to_governorate', 'carrier_company',
+                      'shipment_type_id', 'department_id')
+
+def rename_rollup_key(db, column, old_name, new_name, lookup_id):
+    """
+    نقل صفوف monthly_rollup (وعدادات receipt_counter لعمود from_governorate) من old_name إلى
+    new_name بعد إعادة تسمية عنصر القائمة lookup_id، مع جمعها إلى صفوف الاسم الجديد إن وجدت.
+    """
+    old_name = old_name if old_name is not None else ''
+    if column == 'from_governorate':
+        # العداد لا ينقص أبداً حتى لا يتكرر رقم وصل، لذلك تبقى عدادات الاسم القديم كما هي
         db.execute('''
-            CREATE TABLE IF NOT EXISTS governorate (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL
-            )
-        ''')
-    
-        # إضافة عمود use_boxes إذا لم يكن موجوداً
+            INSERT INTO receipt_counter (governorate, month, last_serial)
+            SELECT ?, month, last_serial FROM receipt_counter WHERE governorate = ?
+            ON CONFLICT (governorate, month) DO UPDATE SET last_serial = MAX(last_serial, excluded.last_serial)
+        ''', [new_name, old_name])
+    table = SHIPMENT_LOOKUP_COLUMNS[column]
+    if db.execute(f'SELECT 1 FROM {table} WHERE name = ? AND id != ?', [old_name, lookup_id]).fetchone():
+        # عنصر آخر بنفس الاسم القديم ما زالت شحناته تحمله: إعادة حساب مجاميع الاسمين فقط
+        db.execute(f'DELETE FROM monthly_rollup WHERE {column} IN (?, ?)', [old_name, new_name])
+        db.execute(f'''
+            INSERT INTO monthly_rollup ({', '.join(ROLLUP_KEY_COLUMNS)}, item_count, quantity, boxes, cost)
+            {ROLLUP_SELECT.format(sign=1, where=f"COALESCE(s.{column}, '') IN (?, ?)")}
+        ''', [old_name, new_name])
+        return
+    keys = ', '.join('?' if key == column else key for key in ROLLUP_KEY_COLUMNS)
+    db.execute(f'''
+        INSERT INTO monthly_rollup ({', '.join(ROLLUP_KEY_COLUMNS)}, item_count, quantity, boxes, cost)
+        SELECT {keys}, item_count, quantity, boxes, cost FROM monthly_rollup WHERE {column} = ?
+        ON CONFLICT ({', '.join(ROLLUP_KEY_COLUMNS)})
+        DO UPDATE SET item_count = item_count + excluded.item_count,
+                      quantity = quantity + excluded.quantity,
+                      boxes = boxes + excluded.boxes,
+                      cost = cost + excluded.cost
+    ''', [new_name, old_name])
+    db.execute(f'DELETE FROM monthly_rollup WHERE {column} = ?', [old_name])
+
+def rebuild_rollup(db):
+    """إعادة بناء جدول المجاميع الشهرية بالكامل من بنود الشحنات."""
+    db.execute('DELETE FROM monthly_rollup')
+    db.execute(f'''
+        INSERT INTO monthly_rollup (month, from_governorate, to_governorate, carrier_company,
+                                    shipment_type_id, department_id, item_count, quantity, boxes, cost)
+        {ROLLUP_SELECT.format(sign=1, where='1=1')}
+    ''')
+
+def monthly_summary(db, from_date, to_date):
+    """
+    مجاميع كل شهر ضمن الفترة بالأيام المحددة (from_date و to_date ضمنها). الأشهر الكاملة
+    تُقرأ من جدول monthly_rollup، والأيام في الشهرين الجزئيين عند طرفي الفترة من البنود مباشرة.
+    """
+    try:
+        start = datetime.strptime(from_date, '%Y-%m-%d')
+        end = datetime.strptime(to_date, '%Y-%m-%d') + timedelta(days=1)
+    except (TypeError, ValueError):
+        return []
+    # أول شهر كامل ضمن الفترة وبداية أول شهر بعد آخر شهر كامل
+    full_start = start if start.day == 1 else (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    full_end = end.replace(day=1)
+    months = {}
+
+    def add(rows):
+        for row in rows:
+            total = months.setdefault(row['month'], {'month': row['month'], 'item_count': 0,
+                                                     'quantity': 0, 'boxes': 0, 'cost': 0})
+            for field in ('item_count', 'quantity', 'boxes', 'cost'):
+                total[field] += row[field] or 0
+
+    if full_start < full_end:
+        add(db.execute('''
+            SELECT month, SUM(item_count) as item_count, SUM(quantity) as quantity,
+                   SUM(boxes) as boxes, SUM(cost) as cost
+            FROM monthly_rollup
+            WHERE month >= ? AND month < ?
+            GROUP BY month
+        ''', [full_start.strftime('%Y-%m'), full_end.strftime('%Y-%m')]))
+        partial = [(start, full_start), (full_end, end)]
+    else:
+        partial = [(start, end)]
+    for part_start, part_end in partial:
+        if part_start >= part_end:
+            continue
+        add(db.execute('''
+            SELECT substr(s.delivery_date, 1, 7) as month, COUNT(*) as item_count,
+                   SUM(si.quantity) as quantity, SUM(si.boxes_count) as boxes,
+                   SUM(CASE WHEN si.use_boxes THEN si.boxes_count ELSE si.quantity END * si.cost) as cost
+            FROM shipment s
+            JOIN shipment_item si ON si.shipment_id = s.id
+            WHERE s.delivery_date >= ? AND s.delivery_date < ?
+            GROUP BY 1
+        ''', [part_start.strftime('%Y-%m-%d'), part_end.strftime('%Y-%m-%d')]))
+    return [months[month] for month in sorted(months)]
+
+@app.cli.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Rebuild the monthly_rollup table from shipment items."""
+    with get_db(write=True) as db:
+        rebuild_rollup(db)
+        count = db.execute('SELECT COUNT(*) FROM monthly_rollup').fetchone()[0]
+    print(f'monthly_rollup rebuilt: {count} rows')
+
+def bump_data_version(db, *names):
+    """زيادة رقم نسخة البيانات للجداول المعدلة (ضمن نفس معاملة التعديل)."""
+    db.executemany('''
+        INSERT INTO data_version (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    ''', [(name,) for name in names])
+
+def get_data_version(db, name):
+    row = db.execute('SELECT version FROM data_version WHERE name = ?', [name]).fetchone()
+    return row[0] if row else 0
+
+def get_data_versions(db, names):
+    """أرقام نسخ عدة جداول في استعلام واحد: {الجدول: النسخة}."""
+    placeholders = ','.join(['?'] * len(names))
+    versions = dict(db.execute(
+        f'SELECT name, version FROM data_version WHERE name IN ({placeholders})', list(names)).fetchall())
+    return {name: versions.get(name, 0) for name in names}
+
+# جداول القوائم المنسدلة التي تتغير فقط من صفحات الإدارة الخاصة بها
+LOOKUP_TABLES = ('governorate', 'carrier_company', 'department', 'shipment_type')
+
+class LookupCache:
+    """
+    نسخة في الذاكرة من جداول القوائم المنسدلة مع رقم نسخة كل جدول في data_version.
+    يعاد تحميل الجدول فقط عندما يتغير رقم نسخته، سواء عدّلته هذه العملية أو عملية أخرى.
+    """
+
+    def __init__(self):
+        self._tables = {}  # {الجدول: (النسخة، الصفوف)}
+        self._options = {}  # {(الجدول، عمود القيمة): (النسخة، HTML)}
+        self._lock = threading.Lock()
+
+    def load(self, db, names=LOOKUP_TABLES):
+        versions = get_data_versions(db, names)
+        result = {}
+        for name in names:
+            version = versions[name]
+            cached = self._tables.get(name)
+            if cached is None or cached[0] != version:
+                rows = tuple(db.execute(f'SELECT * FROM {name} ORDER BY id').fetchall())
+                cached = (version, rows)
+                with self._lock:
+                    self._tables[name] = cached
+            result[name] = cached[1]
+        return result
+
+    def options(self, name, value_field):
+        """
+        عناصر <option> لكل صفوف الجدول كنص HTML جاهز، يعاد بناؤه فقط عند تغير نسخة الجدول.
+        يعتمد على الصفوف المحملة مسبقاً في نفس الطلب عبر get_lookups.
+        """
+        cached = self._tables.get(name)
+        if cached is None:
+            with get_db() as db:
+                self.load(db, (name,))
+            cached = self._tables[name]
+        version, rows = cached
+        key = (name, value_field)
+        fragment = self._options.get(key)
+        if fragment is None or fragment[0] != version:
+            html = ''.join(f'<option value="{escape(row[value_field])}">{escape(row["name"])}</option>'
+                           for row in rows)
+            fragment = (version, html)
+            with self._lock:
+                self._options[key] = fragment
+        return fragment[1]
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._options.clear()
+
+lookup_cache = LookupCache()
+
+@app.template_global()
+def lookup_options(name, selected=None, value='id', keep_unknown=False):
+    """
+    قائمة <option> المخزنة مسبقاً لجدول القوائم المنسدلة مع إضافة selected للقيمة المختارة فقط.
+    keep_unknown: إظهار القيمة المختارة حتى لو لم تعد موجودة في الجدول (فلاتر قائمة الشحنات).
+    """
+    html = lookup_cache.options(name, value)
+    if selected is None or str(selected) == '':
+        return Markup(html)
+    marker = f'<option value="{escape(selected)}">'
+    if marker in html:
+        html = html.replace(marker, marker[:-1] + ' selected>', 1)
+    elif keep_unknown:
+        html = f'<option value="{escape(selected)}" selected>{escape(selected)}</option>' + html
+    return Markup(html)
+
+def get_lookups(db, *names):
+    """صفوف جداول القوائم المنسدلة من الذاكرة المؤقتة (كل الجداول إذا لم تُحدد أسماء)."""
+    return lookup_cache.load(db, names or LOOKUP_TABLES)
+
+def lookup_id(db, table, name):
+    """معرف عنصر القائمة بالاسم (أصغر معرف عند التكرار)، أو None إذا لم يوجد."""
+    return next((row['id'] for row in get_lookups(db, table)[table] if row['name'] == name), None)
+
+def lookup_filter(db, column, name):
+    """
+    شرط فلترة الشحنات باسم محافظة/شركة عبر عمود المعرف المفهرس، أو بالاسم النصي
+    إذا لم يكن الاسم موجوداً في جدول القائمة.
+    """
+    table = SHIPMENT_LOOKUP_COLUMNS[column]
+    ids = [row['id'] for row in get_lookups(db, table)[table] if row['name'] == name]
+    if not ids:
+        return f' AND s.{column} = ?', [name]
+    return f" AND s.{column}_id IN ({','.join(['?'] * len(ids))})", ids
+
+def date_range_filter(column, from_date=None, to_date=None):
+    """
+    شرط نطاق تاريخ يمكنه استخدام الفهرس بدل date(column): column >= from AND column < (to + يوم).
+    يعيد (نص الشرط، المعاملات).
+    """
+    sql = ''
+    params = []
+    if from_date:
+        sql += f' AND {column} >= ?'
+        params.append(from_date)
+    if to_date:
         try:
-            db.execute('ALTER TABLE shipment_item ADD COLUMN use_boxes INTEGER DEFAULT 0')
-        except Exception:
-            pass  # العمود موجود مسبقاً أو حدث خطأ آخر
+            next_day = datetime.strptime(to_date, '%Y-%m-%d') + timedelta(days=1)
+            sql += f' AND {column} < ?'
+            params.append(next_day.strftime('%Y-%m-%d'))
+        except ValueError:
+            sql += f' AND {column} <= ?'
+            params.append(to_date)
+    return sql, params
+
+@contextmanager
+def get_db(write=False):
+    """
+    اتصال من المجمّع ضمن معاملة واحدة. عند write=True يُحجز قفل الكتابة مبكراً (BEGIN IMMEDIATE)
+    بدل الفشل عند التعارض، وتنتظر العملية دورها في طابور الكتابة إذا فُعّل DB_SERIALIZE_WRITES.
+    """
+    if write and app.config['DB_SERIALIZE_WRITES']:
+        timeout = app.config['SQLITE_PRAGMAS'].get('busy_timeout', 5000) / 1000
+        with write_queue.turn(timeout):
+            with _pooled_db(immediate=True) as db:
+                yield db
+    else:
+        with _pooled_db(immediate=write) as db:
+            yield db
 
 @contextmanager
-def get_db():
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
+def _pooled_db(immediate=False):
+    pool = get_pool()
+    db = pool.acquire()
     try:
+        if immediate:
+            db.execute('BEGIN IMMEDIATE')
         yield db
         db.commit()
     except Exception as e:
         db.rollback()
         raise e
     finally:
-        db.close()
+        pool.release(db)
+
+_etag_salt = None
+
+def etag_salt():
+    # يتغير مع كل تحديث للكود أو القوالب حتى لا تُعتمد نسخة قديمة من الصفحة بعد التحديث،
+    # ويبقى واحداً بين عمليات الخادم المختلفة (serve.py) لأنه مبني على أزمنة تعديل الملفات
+    global _etag_salt
+    if _etag_salt is None:
+        paths = [os.path.abspath(__file__)]
+        template_dir = os.path.join(app.root_path, app.template_folder or '')
+        if os.path.isdir(template_dir):
+            paths += [os.path.join(template_dir, name) for name in os.listdir(template_dir)]
+        _etag_salt = str(max((os.path.getmtime(path) for path in paths if os.path.exists(path)), default=0))
+    return _etag_salt
+
+def conditional_get(*tables):
+    """
+    ETag للصفحات المقروءة فقط (GET) مبني على أرقام نسخ الجداول التي تعرضها ومعاملات الطلب.
+    إذا أرسل المتصفح نفس الـ ETag نرد 304 دون تنفيذ استعلامات الصفحة أو عرض القالب.
+    لا يُطبق عند وجود رسائل flash معلقة لأنها تُعرض مرة واحدة ضمن الصفحة.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            with get_db() as db:
+                versions = get_data_versions(db, tables)
+            key = repr((etag_salt(), sorted(versions.items()), request.full_path))
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # المتصفح يحتفظ بالصفحة لكن يتحقق منها مع كل طلب
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+# أحجام الصفحات المسموح بها في قائمة الشحنات
+PAGE_SIZES = (25, 50, 100, 200)
+DEFAULT_PAGE_SIZE = 50
+
+# ذاكرة مؤقتة لعدد الشحنات لكل مجموعة فلاتر: {الفلاتر: (نسخة البيانات، العدد)}
+_shipment_count_cache = {}
+_SHIPMENT_COUNT_CACHE_MAX = 256
+
+def encode_cursor(row):
+    created_at = row['created_at']
+    if isinstance(created_at, datetime):
+        created_at = created_at.strftime(DATETIME_FORMAT)
+    return f"{created_at}|{row['id']}"
+
+def decode_cursor(value):
+    """فك مؤشر الصفحة (created_at|id)، يعيد None إذا كان غير صالح."""
+    if not value or '|' not in value:
+        return None
+    created_at, _, shipment_id = value.rpartition('|')
+    try:
+        return created_at, int(shipment_id)
+    except ValueError:
+        return None
+
+def count_shipments(db, where_sql, params, cache_key):
+    """عدد الشحنات المطابقة للفلاتر، محفوظ مؤقتاً حتى تتغير بيانات الشحنات."""
+    version = get_data_version(db, 'shipment')
+    cached = _shipment_count_cache.get(cache_key)
+    if cached and cached[0] == version:
+        return cached[1]
+    total = db.execute(f'SELECT COUNT(*) FROM shipment s WHERE 1=1{where_sql}', params).fetchone()[0]
+    if len(_shipment_count_cache) >= _SHIPMENT_COUNT_CACHE_MAX:
+        _shipment_count_cache.clear()
+    _shipment_count_cache[cache_key] = (version, total)
+    return total
+
+# حقول البحث في قائمة الشحنات (البحث الشامل 'all' يشمل الملاحظات أيضاً)
+SEARCH_FIELDS = ['shopiny_number', 'receipt_number', 'order_number']
+
+def shipment_search_filter(filter_field, filter_value):
+    """
+    شرط البحث في أرقام الشحنة. يستخدم فهرس shipment_fts (trigram) للبحث الجزئي،
+    ويرجع إلى LIKE للكلمات الأقصر من 3 أحرف أو إذا لم يتوفر FTS5.
+    يعيد (نص الشرط، المعاملات، تعبير MATCH أو None).
+    """
+    value = (filter_value or '').strip()
+    if not value or (filter_field not in SEARCH_FIELDS and filter_field != 'all'):
+        return '', [], None
+    columns = SEARCH_FIELDS + ['notes'] if filter_field == 'all' else [filter_field]
+    if search_index_enabled and len(value) >= 3:
+        phrase = '"' + value.replace('"', '""') + '"'
+        match = phrase if filter_field == 'all' else f'{{{filter_field}}} : {phrase}'
+        return ' AND s.id IN (SELECT rowid FROM shipment_fts WHERE shipment_fts MATCH ?)', [match], match
+    like_sql = ' OR '.join(f's.{column} LIKE ?' for column in columns)
+    return f' AND ({like_sql})', [f'%{value}%'] * len(columns), None
 
 @app.route('/')
+@conditional_get('shipment', 'governorate', 'carrier_company')
 def index():
     from_governorate = request.args.get('from_governorate')
     to_governorate = request.args.get('to_governorate')
     carrier_company = request.args.get('carrier_company')
     filter_field = request.args.get('filter_field')
     filter_value = request.args.get('filter_value')
+    per_page = request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int)
+    if per_page not in PAGE_SIZES:
+        per_page = DEFAULT_PAGE_SIZE
+    after = decode_cursor(request.args.get('after'))
+    offset = max(request.args.get('offset', 0, type=int), 0)  # للبحث الشامل المرتب حسب الصلة فقط
+    before = decode_cursor(request.args.get('before')) if not after else None
     with get_db() as db:
-        db.row_factory = sqlite3.Row
-        query = '''
-            SELECT s.*, GROUP_CONCAT(si.total) as total_amount,
-                   datetime(s.delivery_date) as delivery_date
+        where_sql = ''
+        params = []
+        for column, value in (('from_governorate', from_governorate), ('to_governorate', to_governorate),
+                              ('carrier_company', carrier_company)):
+            if value:
+                column_sql, column_params = lookup_filter(db, column, value)
+                where_sql += column_sql
+                params += column_params
+        search_sql, search_params, match = shipment_search_filter(filter_field, filter_value)
+        total_count = count_shipments(db, where_sql + search_sql, params + search_params, (
+            from_governorate, to_governorate, carrier_company, filter_field, filter_value))
+
+        columns = '''
+            SELECT s.*
             FROM shipment s
-            LEFT JOIN shipment_item si ON s.id = si.shipment_id
-            WHERE 1=1
         '''
-        params = []
-        if from_governorate:
-            query += ' AND s.from_governorate = ?'
-            params.append(from_governorate)
-        if to_governorate:
-            query += ' AND s.to_governorate = ?'
-            params.append(to_governorate)
-        if carrier_company:
-            query += ' AND s.carrier_company = ?'
-            params.append(carrier_company)
-        if filter_field in ['shopiny_number', 'receipt_number', 'order_number'] and filter_value:
-            query += f' AND s.{filter_field} LIKE ?'
-            params.append(f'%{filter_value}%')
-        query += '\nGROUP BY s.id\nORDER BY s.created_at DESC'
-        shipments = db.execute(query, params).fetchall()
-        governorates = db.execute('SELECT name FROM governorate').fetchall()
-        carrier_companies = db.execute('SELECT name FROM carrier_company').fetchall()
-        processed_shipments = []
-        for shipment in shipments:
-            shipment_dict = dict(shipment)
-            try:
-                shipment_dict['delivery_date'] = datetime.strptime(shipment['delivery_date'], '%Y-%m-%d %H:%M:%S')
-            except (ValueError, TypeError):
-                shipment_dict['delivery_date'] = None
-            processed_shipments.append(shipment_dict)
+        ranked = match is not None and filter_field == 'all'
+        if ranked:
+            # البحث الشامل: النتائج مرتبة حسب الصلة (bm25)؛ الترتيب محسوب لكل استعلام فتُرقَّم
+            # الصفحات بالإزاحة (عدد النتائج المطابقة لكلمة بحث محدودة عادةً)
+            query = columns + f'''
+                JOIN shipment_fts ON shipment_fts.rowid = s.id
+                WHERE shipment_fts MATCH ?{where_sql}
+                ORDER BY shipment_fts.rank, s.id
+            '''
+            page_params = [match] + params
+            after = before = None
+        else:
+            # ترقيم الصفحات بالمفتاح (created_at, id) بدل OFFSET
+            query = columns + f'WHERE 1=1{where_sql}{search_sql}'
+            page_params = params + search_params
+            if after:
+                query += ' AND (s.created_at, s.id) < (?, ?)'
+                page_params.extend(after)
+                query += '\nORDER BY s.created_at DESC, s.id DESC'
+            elif before:
+                query += ' AND (s.created_at, s.id) > (?, ?)'
+                page_params.extend(before)
+                query += '\nORDER BY s.created_at ASC, s.id ASC'
+            else:
+                query += '\nORDER BY s.created_at DESC, s.id DESC'
+        query += '\nLIMIT ?'
+        page_params.append(per_page + 1)
+        if ranked:
+            query += ' OFFSET ?'
+            page_params.append(offset)
+        shipments = db.execute(query, page_params).fetchall()
+        has_more = len(shipments) > per_page
+        shipments = shipments[:per_page]
+        if before:
+            shipments.reverse()
+        lookups = get_lookups(db, 'governorate', 'carrier_company')
+        governorates = lookups['governorate']
+        carrier_companies = lookups['carrier_company']
+
+    # روابط الصفحة التالية والسابقة مع الحفاظ على الفلاتر الحالية
+    page_args = {k: v for k, v in {
+        'from_governorate': from_governorate,
+        'to_governorate': to_governorate,
+        'carrier_company': carrier_company,
+        'filter_field': filter_field,
+        'filter_value': filter_value,
+        'per_page': per_page if per_page != DEFAULT_PAGE_SIZE else None,
+    }.items() if v}
+    next_url = prev_url = None
+    if ranked:
+        if has_more:
+            next_url = url_for('index', offset=offset + per_page, **page_args)
+        if offset:
+            prev_url = url_for('index', offset=max(offset - per_page, 0) or None, **page_args)
+    elif shipments:
+        # عند الرجوع للخلف (before) توجد دائماً صفحة تالية لأننا جئنا منها
+        if has_more or before:
+            next_url = url_for('index', after=encode_cursor(shipments[-1]), **page_args)
+        if after or (before and has_more):
+            prev_url = url_for('index', before=encode_cursor(shipments[0]), **page_args)
     return render_template(
         'index.html',
-        shipments=processed_shipments,
+        shipments=shipments,
         governorates=governorates,
         carrier_companies=carrier_companies,
         selected_from_governorate=from_governorate,
         selected_to_governorate=to_governorate,
         selected_carrier_company=carrier_company,
         filter_field=filter_field,
-        filter_value=filter_value
+        filter_value=filter_value,
+        per_page=per_page,
+        page_sizes=PAGE_SIZES,
+        default_page_size=DEFAULT_PAGE_SIZE,
+        total_count=total_count,
+        next_url=next_url,
+        prev_url=prev_url
     )
 
+# أعمدة بنود الشحنة بالترتيب المستخدم في الإدراج والتحديث
+ITEM_FIELDS = ('shipment_type_id', 'department_id', 'quantity', 'cost', 'boxes_count', 'total', 'notes', 'use_boxes')
+
+def form_item_indexes(form):
+    """أرقام صفوف البنود الموجودة في النموذج (قد تكون غير متتالية بعد حذف صف من الجدول)."""
+    return sorted({int(m.group(1)) for key in form
+                   for m in [re.fullmatch(r'items\[(\d+)\]\[shipment_type_id\]', key)] if m})
+
+def parse_form_items(form):
+    """بنود الشحنة من النموذج كقواميس جاهزة للحفظ، مع رقم البند إن كان موجوداً مسبقاً."""
+    items = []
+    for i in form_item_indexes(form):
+        quantity = int(float(form[f'items[{i}][quantity]']))
+        cost = int(float(form[f'items[{i}][cost]']))
+        boxes_count = int(float(form[f'items[{i}][boxes_count]']))
+        use_boxes = 1 if form.get(f'items[{i}][use_boxes]') else 0
+        item_id = form.get(f'items[{i}][id]', '')
+        items.append({
+            'id': int(item_id) if item_id.isdigit() else None,
+            'shipment_type_id': int(form[f'items[{i}][shipment_type_id]']),
+            'department_id': int(form[f'items[{i}][department_id]']),
+            'quantity': quantity,
+            'cost': cost,
+            'boxes_count': boxes_count,
+            # المجموع حسب الكراتين أو الكمية
+            'total': boxes_count * cost if use_boxes else quantity * cost,
+            'notes': form.get(f'items[{i}][notes]', ''),
+            'use_boxes': use_boxes,
+        })
+    return items
+
+def insert_items(db, shipment_id, items):
+    db.executemany(f'''
+        INSERT INTO shipment_item (shipment_id, {', '.join(ITEM_FIELDS)})
+        VALUES (?, {', '.join(['?'] * len(ITEM_FIELDS))})
+    ''', [[shipment_id] + [item[f] for f in ITEM_FIELDS] for item in items])
+
+def save_items(db, shipment_id, items, existing):
+    """
+    حفظ بنود الشحنة بالفرق عن البنود الحالية: إدراج الجديد، تحديث المتغير فقط، وحذف المحذوف.
+    أرقام البنود التي بقيت تبقى ثابتة.
+    """
+    existing = {row['id']: row for row in existing}
+    new_items, changed = [], []
+    kept = set()
+    for item in items:
+        row = existing.get(item['id'])
+        if row is None or item['id'] in kept:
+            new_items.append(item)
+            continue
+        kept.add(item['id'])
+        if any(row[f] != item[f] for f in ITEM_FIELDS):
+            changed.append(item)
+    removed = [(item_id,) for item_id in existing if item_id not in kept]
+    if removed:
+        db.executemany('DELETE FROM shipment_item WHERE id = ?', removed)
+    if changed:
+        db.executemany(f'''
+            UPDATE shipment_item SET {', '.join(f + ' = ?' for f in ITEM_FIELDS)}
+            WHERE id = ?
+        ''', [[item[f] for f in ITEM_FIELDS] + [item['id']] for item in changed])
+    if new_items:
+        insert_items(db, shipment_id, new_items)
+    return len(new_items), len(changed), len(removed)
+
+# رسائل الخطأ لقيود UNIQUE في جدول الشحنات
+UNIQUE_FIELD_ERRORS = {
+    'shipment.shopiny_number': 'رقم الشحنة مستخدم من قبل، يرجى اختيار رقم آخر.',
+    'shipment.receipt_number': 'رقم وصل شحن جبال مستخدم من قبل، يرجى اختيار رقم آخر.',
+}
+
+def unique_violation_message(error):
+    """رسالة الخطأ المناسبة لخرق قيد UNIQUE، أو None إذا كان الخطأ من نوع آخر."""
+    text = str(error)
+    if not text.startswith('UNIQUE constraint failed'):
+        return None
+    for column, message in UNIQUE_FIELD_ERRORS.items():
+        if column in text:
+            return message
+    return None
+
 @app.route('/shipment/new', methods=['GET', 'POST'])
 def new_shipment():
-    with get_db() as db:
-        departments = db.execute('SELECT * FROM department').fetchall()
-        carrier_companies = db.execute('SELECT * FROM carrier_company').fetchall()
-        shipment_types = db.execute('SELECT * FROM shipment_type').fetchall()
-        governorates = db.execute('SELECT * FROM governorate').fetchall()
+    with get_db(write=request.method == 'POST') as db:
+        lookups = get_lookups(db)
+        departments = lookups['department']
+        carrier_companies = lookups['carrier_company']
+        shipment_types = lookups['shipment_type']
+        governorates = lookups['governorate']
         
         if request.method == 'POST':
             # Validate required fields
@@ -188,15 +1398,14 @@ def new_shipment():
             ]
             missing = [f for f in required_fields if not request.form.get(f)]
             # At least one item required
-            if not any(k.startswith('items[0]') for k in request.form):
+            item_indexes = form_item_indexes(request.form)
+            if not item_indexes:
                 missing.append('items')
             # Check items fields
-            i = 0
-            while f'items[{i}][shipment_type_id]' in request.form:
+            for i in item_indexes:
                 for item_field in ['shipment_type_id', 'department_id', 'quantity', 'cost', 'boxes_count']:
                     if not request.form.get(f'items[{i}][{item_field}]'):
                         missing.append(f'items[{i}][{item_field}]')
-                i += 1
             if missing:
                 flash('جميع الحقول مطلوبة عدا الملاحظات. يرجى تعبئة جميع الحقول.', 'error')
                 # إعادة عرض الصفحة مع نفس البيانات المدخلة وعدم تصفيرها
@@ -207,21 +1416,39 @@ def new_shipment():
                     governorates=governorates,
                     form=request.form,
                     missing=missing)
-            # تحقق من تكرار رقم الشحنة
-            existing = db.execute('SELECT id FROM shipment WHERE shopiny_number = ?', [request.form['shopiny_number']]).fetchone()
-            if existing:
-                flash('رقم الشحنة مستخدم من قبل، يرجى اختيار رقم آخر.', 'error')
-                return render_template('new_shipment.html',
-                    departments=departments,
-                    carrier_companies=carrier_companies,
-                    shipment_types=shipment_types,
-                    governorates=governorates,
-                    form=request.form,
-                    missing=missing)
-            # تحقق من تكرار رقم وصل شحن جبال
-            existing_receipt = db.execute('SELECT id FROM shipment WHERE receipt_number = ?', [request.form['receipt_number']]).fetchone()
-            if existing_receipt:
-                flash('رقم وصل شحن جبال مستخدم من قبل، يرجى اختيار رقم آخر.', 'error')
+            # حجز رقم وصل شحن جبال من العداد: الرقم المعروض في النموذج مجرد معاينة وقد يكون
+            # مستخدم آخر قد حجزه في نفس الوقت
+            receipt_number = generate_shopiny_number(
+                db, request.form['source_governorate'], request.form['delivery_date'], allocate=True
+            ) or request.form['receipt_number']
+            # First insert the shipment: تكرار رقم الشحنة أو رقم الوصل تكشفه قيود UNIQUE نفسها
+            try:
+                cursor = db.execute('''
+                    INSERT INTO shipment (
+                        shopiny_number, receipt_number, order_number,
+                        delivery_date, from_governorate, to_governorate,
+                        carrier_company, notes,
+                        from_governorate_id, to_governorate_id, carrier_company_id
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    request.form['shopiny_number'],
+                    receipt_number,
+                    request.form['order_number'],
+                    datetime.strptime(request.form['delivery_date'], '%Y-%m-%d'),
+                    request.form['source_governorate'],
+                    request.form['destination_governorate'],
+                    request.form['carrier_company'],
+                    request.form.get('notes', ''),
+                    lookup_id(db, 'governorate', request.form['source_governorate']),
+                    lookup_id(db, 'governorate', request.form['destination_governorate']),
+                    lookup_id(db, 'carrier_company', request.form['carrier_company'])
+                ])
+            except sqlite3.IntegrityError as e:
+                message = unique_violation_message(e)
+                if message is None:
+                    raise
+                db.rollback()  # عدم استهلاك رقم من العداد
+                flash(message, 'error')
                 return render_template('new_shipment.html',
                     departments=departments,
                     carrier_companies=carrier_companies,
@@ -229,54 +1456,18 @@ def new_shipment():
                     governorates=governorates,
                     form=request.form,
                     missing=missing)
-            # First insert the shipment
-            cursor = db.execute('''
-                INSERT INTO shipment (
-                    shopiny_number, receipt_number, order_number,
-                    delivery_date, from_governorate, to_governorate,
-                    carrier_company, notes
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', [
-                request.form['shopiny_number'],
-                request.form['receipt_number'],
-                request.form['order_number'],
-                datetime.strptime(request.form['delivery_date'], '%Y-%m-%d').strftime('%Y-%m-%d %H:%M:%S'),
-                request.form['source_governorate'],
-                request.form['destination_governorate'],
-                request.form['carrier_company'],
-                request.form.get('notes', '')
-            ])
             
             shipment_id = cursor.lastrowid
             
-            # Handle multiple items (total always boxes_count * cost)
-            i = 0
-            while f'items[{i}][shipment_type_id]' in request.form:
-                quantity = int(request.form[f'items[{i}][quantity]'])
-                cost = int(request.form[f'items[{i}][cost]'])
-                boxes_count = int(request.form[f'items[{i}][boxes_count]'])
-                use_boxes = 1 if request.form.get(f'items[{i}][use_boxes]') else 0
-                # تعديل حساب total ليعتمد على use_boxes
-                total = boxes_count * cost if use_boxes else quantity * cost
-                db.execute('''
-                    INSERT INTO shipment_item (
-                        shipment_id, shipment_type_id, department_id,
-                        quantity, cost, boxes_count, total, notes, use_boxes
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', [
-                    shipment_id,
-                    request.form[f'items[{i}][shipment_type_id]'],
-                    request.form[f'items[{i}][department_id]'],
-                    quantity,
-                    cost,
-                    boxes_count,
-                    total,
-                    request.form.get(f'items[{i}][notes]', ''),
-                    use_boxes
-                ])
-                i += 1
+            # Handle multiple items
+            insert_items(db, shipment_id, parse_form_items(request.form))
+            refresh_shipment_totals(db, shipment_id)
                 
+            apply_rollup(db, shipment_id, 1)
+            bump_data_version(db, 'shipment')
             flash('تم إضافة الشحنة بنجاح', 'success')
+            if receipt_number != request.form['receipt_number']:
+                flash(f'تم حجز رقم وصل شحن جبال {receipt_number} لأن الرقم المعروض استُخدم من قبل.', 'warning')
             return redirect(url_for('index'))
             
     # توليد رقم وصل شحن جبال تلقائيًا عند GET فقط، أو عند POST إذا لم يكن موجودًا في form
@@ -294,19 +1485,13 @@ def new_shipment():
                          shopiny_number=shopiny_number)
 
 @app.route('/shipment/<int:id>')
+@conditional_get('shipment', 'shipment_type', 'department')
 def view_shipment(id):
     with get_db() as db:
-        shipment_row = db.execute('''
-            SELECT *, datetime(delivery_date) as delivery_date 
-            FROM shipment WHERE id = ?
-        ''', [id]).fetchone()
-        
-        # Convert to dict and process date
-        shipment = dict(shipment_row)
-        try:
-            shipment['delivery_date'] = datetime.strptime(shipment['delivery_date'], '%Y-%m-%d %H:%M:%S')
-        except (ValueError, TypeError):
-            shipment['delivery_date'] = None
+        # delivery_date يصل كـ datetime جاهز من محول DATETIME
+        shipment = db.execute('SELECT * FROM shipment WHERE id = ?', [id]).fetchone()
+        if shipment is None:
+            abort(404)
         
         # Get items separately
         items = db.execute('''
@@ -316,36 +1501,16 @@ def view_shipment(id):
             JOIN department d ON si.department_id = d.id
             WHERE si.shipment_id = ?
         ''', [id]).fetchall()
-        # حساب المجموع الكلي
-        total_sum = 0
-        for item in items:
-            try:
-                # إذا كان الحقل use_boxes موجودًا ويعتمد عليه
-                if 'use_boxes' in item.keys() and item['use_boxes']:
-                    total_sum += int(item['boxes_count']) * int(item['cost'])
-                else:
-                    total_sum += int(item['quantity']) * int(item['cost'])
-            except Exception:
-                pass
-    return render_template('view_shipment.html', shipment=shipment, items=items, total_sum=total_sum)
+    # المجموع الكلي محفوظ مع الشحنة (total_amount)
+    return render_template('view_shipment.html', shipment=shipment, items=items, total_sum=shipment['total_amount'])
 
 @app.route('/shipment/<int:id>/edit', methods=['GET', 'POST'])
 def edit_shipment(id):
-    with get_db() as db:
+    with get_db(write=request.method == 'POST') as db:
         # Fetch the shipment
-        shipment_row = db.execute('''
-            SELECT *, datetime(delivery_date) as delivery_date
-            FROM shipment 
-            WHERE id = ?
-        ''', [id]).fetchone()
-        
-        # Convert to dict and process date
-        shipment = dict(shipment_row)
-        try:
-            if shipment['delivery_date']:
-                shipment['delivery_date'] = datetime.strptime(shipment['delivery_date'], '%Y-%m-%d %H:%M:%S')
-        except (ValueError, TypeError):
-            shipment['delivery_date'] = None
+        shipment = db.execute('SELECT * FROM shipment WHERE id = ?', [id]).fetchone()
+        if shipment is None:
+            abort(404)
         
         # Fetch the items for this shipment with their related data
         items = db.execute('''
@@ -357,10 +1522,11 @@ def edit_shipment(id):
         ''', [id]).fetchall()
         
         # Fetch lookup data for dropdowns
-        departments = db.execute('SELECT * FROM department').fetchall()
-        carrier_companies = db.execute('SELECT * FROM carrier_company').fetchall()
-        shipment_types = db.execute('SELECT * FROM shipment_type').fetchall()
-        governorates = db.execute('SELECT * FROM governorate').fetchall()
+        lookups = get_lookups(db)
+        departments = lookups['department']
+        carrier_companies = lookups['carrier_company']
+        shipment_types = lookups['shipment_type']
+        governorates = lookups['governorate']
         
         if request.method == 'POST':
             # Validate required fields
@@ -370,15 +1536,14 @@ def edit_shipment(id):
             ]
             missing = [f for f in required_fields if not request.form.get(f)]
             # At least one item required
-            if not any(k.startswith('items[0]') for k in request.form):
+            item_indexes = form_item_indexes(request.form)
+            if not item_indexes:
                 missing.append('items')
             # Check items fields
-            i = 0
-            while f'items[{i}][shipment_type_id]' in request.form:
+            for i in item_indexes:
                 for item_field in ['shipment_type_id', 'department_id', 'quantity', 'cost', 'boxes_count']:
                     if not request.form.get(f'items[{i}][{item_field}]'):
                         missing.append(f'items[{i}][{item_field}]')
-                i += 1
             if missing:
                 flash('جميع الحقول مطلوبة عدا الملاحظات. يرجى تعبئة جميع الحقول.', 'error')
                 return render_template('edit_shipment.html',
@@ -389,54 +1554,54 @@ def edit_shipment(id):
                          shipment_types=shipment_types,
                          governorates=governorates,
                          form=request.form if request.method == 'POST' else None)
+            # طرح المجاميع القديمة قبل التعديل
+            apply_rollup(db, id, -1)
             # Update shipment
-            db.execute('''
-                UPDATE shipment SET
-                    shopiny_number = ?, receipt_number = ?, 
-                    order_number = ?, delivery_date = ?,
-                    from_governorate = ?, to_governorate = ?,
-                    carrier_company = ?, notes = ?
-                WHERE id = ?
-            ''', [
-                request.form['shopiny_number'],
-                request.form['receipt_number'],
-                request.form['order_number'],
-                datetime.strptime(request.form['delivery_date'], '%Y-%m-%d').strftime('%Y-%m-%d %H:%M:%S'),
-                request.form['source_governorate'],
-                request.form['destination_governorate'],
-                request.form['carrier_company'],
-                request.form.get('notes', ''),
-                id
-            ])
-            
-            db.execute('DELETE FROM shipment_item WHERE shipment_id = ?', [id])
-            
-            # Insert updated items (total always boxes_count * cost)
-            i = 0
-            while f'items[{i}][shipment_type_id]' in request.form:
-                quantity = int(float(request.form[f'items[{i}][quantity]']))
-                cost = int(float(request.form[f'items[{i}][cost]']))
-                boxes_count = int(float(request.form[f'items[{i}][boxes_count]']))
-                use_boxes = 1 if request.form.get(f'items[{i}][use_boxes]') else 0
-                total = boxes_count * cost if use_boxes else quantity * cost
+            try:
                 db.execute('''
-                    INSERT INTO shipment_item (
-                        shipment_id, shipment_type_id, department_id,
-                        quantity, cost, boxes_count, total, notes, use_boxes
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    UPDATE shipment SET
+                        shopiny_number = ?, receipt_number = ?, 
+                        order_number = ?, delivery_date = ?,
+                        from_governorate = ?, to_governorate = ?,
+                        carrier_company = ?, notes = ?,
+                        from_governorate_id = ?, to_governorate_id = ?, carrier_company_id = ?
+                    WHERE id = ?
                 ''', [
-                    id,
-                    request.form[f'items[{i}][shipment_type_id]'],
-                    request.form[f'items[{i}][department_id]'],
-                    quantity,
-                    cost,
-                    boxes_count,
-                    total,
-                    request.form.get(f'items[{i}][notes]', ''),
-                    use_boxes
+                    request.form['shopiny_number'],
+                    request.form['receipt_number'],
+                    request.form['order_number'],
+                    datetime.strptime(request.form['delivery_date'], '%Y-%m-%d'),
+                    request.form['source_governorate'],
+                    request.form['destination_governorate'],
+                    request.form['carrier_company'],
+                    request.form.get('notes', ''),
+                    lookup_id(db, 'governorate', request.form['source_governorate']),
+                    lookup_id(db, 'governorate', request.form['destination_governorate']),
+                    lookup_id(db, 'carrier_company', request.form['carrier_company']),
+                    id
                 ])
-                i += 1
+            except sqlite3.IntegrityError as e:
+                message = unique_violation_message(e)
+                if message is None:
+                    raise
+                db.rollback()
+                flash(message, 'error')
+                return render_template('edit_shipment.html',
+                         shipment=shipment,
+                         items=items,
+                         departments=departments,
+                         carrier_companies=carrier_companies,
+                         shipment_types=shipment_types,
+                         governorates=governorates,
+                         form=request.form)
             
+            # حفظ البنود بالفرق عن البنود الحالية بدل حذفها كلها وإعادة إدراجها
+            save_items(db, id, parse_form_items(request.form), items)
+            refresh_shipment_totals(db, id)
+            
+            apply_rollup(db, id, 1)
+            seed_receipt_counters(db, shipment_id=id)
+            bump_data_version(db, 'shipment')
             flash('تم تحديث الشحنة بنجاح', 'success')
             return redirect(url_for('index'))
             
@@ -451,19 +1616,22 @@ def edit_shipment(id):
 
 @app.route('/shipment/<int:id>/delete', methods=['POST'])
 def delete_shipment(id):
-    with get_db() as db:
+    with get_db(write=True) as db:
+        apply_rollup(db, id, -1)
         db.execute('DELETE FROM shipment_item WHERE shipment_id = ?', [id])
         db.execute('DELETE FROM shipment WHERE id = ?', [id])
+        bump_data_version(db, 'shipment')
         flash('تم حذف الشحنة بنجاح', 'success')
     return redirect(url_for('index'))
 
 @app.route('/shipment-type/new', methods=['GET', 'POST'])
 def new_shipment_type():
     if request.method == 'POST':
-        with get_db() as db:
+        with get_db(write=True) as db:
             db.execute('''
                 INSERT INTO shipment_type (name) VALUES (?)
             ''', [request.form['name']])
+            bump_data_version(db, 'shipment_type')
             flash('تم إضافة نوع الشحنة بنجاح', 'success')
             return redirect(url_for('index'))
     return render_template('new_shipment_type.html')
@@ -471,10 +1639,11 @@ def new_shipment_type():
 @app.route('/department/new', methods=['GET', 'POST'])
 def new_department():
     if request.method == 'POST':
-        with get_db() as db:
+        with get_db(write=True) as db:
             db.execute('''
                 INSERT INTO department (name) VALUES (?)
             ''', [request.form['name']])
+            bump_data_version(db, 'department')
             flash('تم إضافة القسم بنجاح', 'success')
             return redirect(url_for('index'))
     return render_template('new_department.html')
@@ -482,265 +1651,414 @@ def new_department():
 @app.route('/shipment-types')
 def list_shipment_types():
     with get_db() as db:
-        shipment_types = db.execute('SELECT * FROM shipment_type').fetchall()
+        shipment_types = get_lookups(db, 'shipment_type')['shipment_type']
     return render_template('list_shipment_types.html', shipment_types=shipment_types)
 
 @app.route('/shipment-type/<int:id>/edit', methods=['GET', 'POST'])
 def edit_shipment_type(id):
-    with get_db() as db:
+    with get_db(write=request.method == 'POST') as db:
         shipment_type = db.execute('SELECT * FROM shipment_type WHERE id = ?', [id]).fetchone()
         if request.method == 'POST':
             db.execute('''
                 UPDATE shipment_type SET name = ? WHERE id = ?
             ''', [request.form['name'], id])
+            bump_data_version(db, 'shipment_type')
             flash('تم تحديث نوع الشحنة بنجاح', 'success')
             return redirect(url_for('list_shipment_types'))
     return render_template('edit_shipment_type.html', shipment_type=shipment_type)
 
 @app.route('/shipment-type/<int:id>/delete', methods=['POST'])
 def delete_shipment_type(id):
-    with get_db() as db:
+    with get_db(write=True) as db:
         db.execute('DELETE FROM shipment_type WHERE id = ?', [id])
+        bump_data_version(db, 'shipment_type')
         flash('تم حذف نوع الشحنة بنجاح', 'success')
     return redirect(url_for('list_shipment_types'))
 
 @app.route('/departments')
 def list_departments():
     with get_db() as db:
-        departments = db.execute('SELECT * FROM department').fetchall()
+        departments = get_lookups(db, 'department')['department']
     return render_template('list_departments.html', departments=departments)
 
 @app.route('/department/<int:id>/edit', methods=['GET', 'POST'])
 def edit_department(id):
-    with get_db() as db:
+    with get_db(write=request.method == 'POST') as db:
         department = db.execute('SELECT * FROM department WHERE id = ?', [id]).fetchone()
         if request.method == 'POST':
             db.execute('''
                 UPDATE department SET name = ? WHERE id = ?
             ''', [request.form['name'], id])
+            bump_data_version(db, 'department')
             flash('تم تحديث القسم بنجاح', 'success')
             return redirect(url_for('list_departments'))
     return render_template('edit_department.html', department=department)
 
 @app.route('/department/<int:id>/delete', methods=['POST'])
 def delete_department(id):
-    with get_db() as db:
+    with get_db(write=True) as db:
         db.execute('DELETE FROM department WHERE id = ?', [id])
+        bump_data_version(db, 'department')
         flash('تم حذف القسم بنجاح', 'success')
     return redirect(url_for('list_departments'))
 
 @app.route('/carrier-companies')
 def list_carrier_companies():
     with get_db() as db:
-        companies = db.execute('SELECT * FROM carrier_company').fetchall()
+        companies = get_lookups(db, 'carrier_company')['carrier_company']
     return render_template('list_carrier_companies.html', companies=companies)
 
 @app.route('/carrier-company/new', methods=['GET', 'POST'])
 def new_carrier_company():
     if request.method == 'POST':
-        with get_db() as db:
+        with get_db(write=True) as db:
             db.execute('''
                 INSERT INTO carrier_company (name) VALUES (?)
             ''', [request.form['name']])
+            bump_data_version(db, 'carrier_company')
+            if link_shipment_lookups(db):
+                bump_data_version(db, 'shipment')
             flash('تم إضافة شركة النقل بنجاح', 'success')
             return redirect(url_for('list_carrier_companies'))
     return render_template('new_carrier_company.html')
 
 @app.route('/carrier-company/<int:id>/edit', methods=['GET', 'POST'])
 def edit_carrier_company(id):
-    with get_db() as db:
+    with get_db(write=request.method == 'POST') as db:
         company = db.execute('SELECT * FROM carrier_company WHERE id = ?', [id]).fetchone()
         if request.method == 'POST':
             db.execute('''
                 UPDATE carrier_company SET name = ? WHERE id = ?
             ''', [request.form['name'], id])
+            bump_data_version(db, 'carrier_company')
+            rename_shipment_lookup(db, 'carrier_company', id, request.form['name'])
             flash('تم تحديث شركة النقل بنجاح', 'success')
             return redirect(url_for('list_carrier_companies'))
     return render_template('edit_carrier_company.html', company=company)
 
 @app.route('/carrier-company/<int:id>/delete', methods=['POST'])
 def delete_carrier_company(id):
-    with get_db() as db:
+    with get_db(write=True) as db:
         db.execute('DELETE FROM carrier_company WHERE id = ?', [id])
+        bump_data_version(db, 'carrier_company')
+        unlink_shipment_lookup(db, 'carrier_company', id)
         flash('تم حذف شركة النقل بنجاح', 'success')
     return redirect(url_for('list_carrier_companies'))
 
 @app.route('/governorates')
 def list_governorates():
     with get_db() as db:
-        governorates = db.execute('SELECT * FROM governorate').fetchall()
+        governorates = get_lookups(db, 'governorate')['governorate']
     return render_template('list_governorates.html', governorates=governorates)
 
 @app.route('/governorate/new', methods=['GET', 'POST'])
 def new_governorate():
     if request.method == 'POST':
-        with get_db() as db:
+        with get_db(write=True) as db:
             db.execute('INSERT INTO governorate (name) VALUES (?)',
                       [request.form['name']])
+            bump_data_version(db, 'governorate')
+            if link_shipment_lookups(db):
+                bump_data_version(db, 'shipment')
             flash('تم إضافة المحافظة بنجاح', 'success')
             return redirect(url_for('list_governorates'))
     return render_template('new_governorate.html')
 
 @app.route('/governorate/<int:id>/edit', methods=['GET', 'POST'])
 def edit_governorate(id):
-    with get_db() as db:
+    with get_db(write=request.method == 'POST') as db:
         governorate = db.execute('SELECT * FROM governorate WHERE id = ?',
                                [id]).fetchone()
         if request.method == 'POST':
             db.execute('UPDATE governorate SET name = ? WHERE id = ?',
                       [request.form['name'], id])
+            bump_data_version(db, 'governorate')
+            rename_shipment_lookup(db, 'governorate', id, request.form['name'])
             flash('تم تحديث المحافظة بنجاح', 'success')
             return redirect(url_for('list_governorates'))
     return render_template('edit_governorate.html', governorate=governorate)
 
 @app.route('/governorate/<int:id>/delete', methods=['POST'])
 def delete_governorate(id):
-    with get_db() as db:
+    with get_db(write=True) as db:
         db.execute('DELETE FROM governorate WHERE id = ?', [id])
+        bump_data_version(db, 'governorate')
+        unlink_shipment_lookup(db, 'governorate', id)
         flash('تم حذف المحافظة بنجاح', 'success')
     return redirect(url_for('list_governorates'))
 
-@app.route('/reports/monthly', methods=['GET', 'POST'])
-def reports_monthly():
-    from_date = request.form.get('from_date')
-    to_date = request.form.get('to_date')
-    shipments = []
+def iter_report(db, from_date=None, to_date=None, carrier_company=None, shipment_type=None, department=None):
+    """
+    محرك التقارير: استعلام واحد يجمع الشحنات مع بنودها (مرتبة حسب تاريخ التسليم)،
+    والمجاميع (الكمية، الكراتين، الكلفة حسب use_boxes) محسوبة في SQL بدوال النافذة.
+    يعيد مولّداً من (الشحنة، قائمة بنودها، المجاميع) بالمرور مرة واحدة على النتائج.
+    فلترة الصنف والقسم تطبق على البنود فقط، فقد تعود شحنة بدون بنود مطابقة.
+    """
+    item_filter = ''
+    params = []
+    if shipment_type:
+        item_filter += ' AND si.shipment_type_id = ?'
+        params.append(shipment_type)
+    if department:
+        item_filter += ' AND si.department_id = ?'
+        params.append(department)
+    date_sql, date_params = date_range_filter('s.delivery_date', from_date, to_date)
+    params += date_params
+    query = f'''
+        SELECT s.id, s.shopiny_number, s.receipt_number, s.order_number, s.delivery_date,
+               s.from_governorate, s.to_governorate, s.carrier_company,
+               c.name as carrier_company_name, fg.name as from_gov_name, tg.name as to_gov_name,
+               si.id as item_id, si.shipment_type_id, si.department_id, si.quantity, si.cost,
+               si.boxes_count, si.total, si.notes, si.use_boxes,
+               st.name as shipment_type_name, d.name as department_name,
+               SUM(si.quantity) OVER () as total_quantity,
+               SUM(si.boxes_count) OVER () as total_boxes,
+               SUM(CASE WHEN si.use_boxes THEN si.boxes_count ELSE si.quantity END * si.cost) OVER () as total_cost
+        FROM shipment s
+        LEFT JOIN carrier_company c ON c.id = s.carrier_company_id
+        LEFT JOIN governorate fg ON fg.id = s.from_governorate_id
+        LEFT JOIN governorate tg ON tg.id = s.to_governorate_id
+        LEFT JOIN (shipment_item si
+                   JOIN shipment_type st ON si.shipment_type_id = st.id
+                   JOIN department d ON si.department_id = d.id)
+            ON si.shipment_id = s.id{item_filter}
+        WHERE 1=1{date_sql}
+    '''
+    if carrier_company:
+        carrier_sql, carrier_params = lookup_filter(db, 'carrier_company', carrier_company)
+        query += carrier_sql
+        params += carrier_params
+    query += ' ORDER BY s.delivery_date ASC, s.id, si.id'
+
+    shipment = None
     items = []
-    with get_db() as db:
-        # تعديل الاستعلام ليكون بدون ربط shipment_item وضمان عدم تكرار الشحنات
-        # تعديل الترتيب ليكون تصاعديًا حسب تاريخ تسليم الشحنة
-        query = '''
-            SELECT DISTINCT s.id, s.*, c.name as carrier_company_name, g1.name as from_gov_name, g2.name as to_gov_name
-            FROM shipment s
-            LEFT JOIN carrier_company c ON s.carrier_company = c.name
-            LEFT JOIN governorate g1 ON s.from_governorate = g1.name
-            LEFT JOIN governorate g2 ON s.to_governorate = g2.name
-            WHERE 1=1
-        '''
-        params = []
-        if from_date:
-            query += ' AND date(s.delivery_date) >= ?'
-            params.append(from_date)
-        if to_date:
-            query += ' AND date(s.delivery_date) <= ?'
-            params.append(to_date)
-        # تعديل ترتيب النتائج ليكون تصاعديًا حسب تاريخ التسليم
-        query += ' GROUP BY s.id ORDER BY s.delivery_date ASC'
-        shipments = db.execute(query, params).fetchall()
-        
-        # جلب البنود بشكل منفصل
-        shipment_ids = [str(s['id']) for s in shipments]
-        items = []
-        if shipment_ids:
-            q = f"SELECT si.*, st.name as shipment_type_name, d.name as department_name FROM shipment_item si JOIN shipment_type st ON si.shipment_type_id=st.id JOIN department d ON si.department_id=d.id WHERE si.shipment_id IN ({','.join(['?']*len(shipment_ids))})"
-            items = db.execute(q, shipment_ids).fetchall()
-    
-    # تنظيم البنود حسب رقم الشحنة
-    items_by_shipment = {}
-    total_cost = 0
-    total_quantity = 0
-    total_boxes = 0
-    
-    for item in items:
-        items_by_shipment.setdefault(item['shipment_id'], []).append(item)
-        # تعديل حساب مجموع كلفة الشحنة ليعتمد على use_boxes
+    for row in db.execute(query, params):
+        if shipment is None or row['id'] != shipment['id']:
+            if shipment is not None:
+                yield shipment, items, totals
+            shipment = {key: row[key] for key in REPORT_SHIPMENT_FIELDS}
+            items = []
+            totals = {
+                'total_quantity': row['total_quantity'] or 0,
+                'total_boxes': row['total_boxes'] or 0,
+                'total_cost': row['total_cost'] or 0,
+            }
+        if row['item_id'] is not None:
+            item = {key: row[key] for key in REPORT_ITEM_FIELDS}
+            item['id'] = row['item_id']
+            item['shipment_id'] = row['id']
+            items.append(item)
+    if shipment is not None:
+        yield shipment, items, totals
+
+REPORT_SHIPMENT_FIELDS = (
+    'id', 'shopiny_number', 'receipt_number', 'order_number', 'delivery_date',
+    'from_governorate', 'to_governorate', 'carrier_company',
+    'carrier_company_name', 'from_gov_name', 'to_gov_name',
+)
+REPORT_ITEM_FIELDS = (
+    'shipment_type_id', 'department_id', 'quantity', 'cost', 'boxes_count',
+    'total', 'notes', 'use_boxes', 'shipment_type_name', 'department_name',
+)
+
+REPORT_FILTERS = ('from_date', 'to_date', 'carrier_company', 'shipment_type', 'department')
+
+def normalize_report_filters(filters):
+    """فلاتر التقرير بصيغة موحدة حتى تتطابق الطلبات المتكافئة في مفتاح الذاكرة المؤقتة."""
+    result = {}
+    for name in REPORT_FILTERS:
+        value = filters.get(name) or None
+        if value and name != 'carrier_company':
+            value = value.strip() or None
+        if value and name in ('from_date', 'to_date'):
+            try:
+                value = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except ValueError:
+                pass
+        elif value and name in ('shipment_type', 'department') and value.isdigit():
+            # معرفات الصنف والقسم فقط؛ اسم الشركة الناقلة نص حر يبقى كما هو (قد يكون "007")
+            value = str(int(value))
+        result[name] = value
+    return result
+
+def _report_json_encode(value):
+    # التواريخ في نتائج التقارير (delivery_date) تُحفظ نصاً بصيغة التخزين نفسها
+    if isinstance(value, datetime):
+        return {'$datetime': value.strftime(DATETIME_FORMAT)}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def _report_json_decode(obj):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.strptime(obj['$datetime'], DATETIME_FORMAT)
+    return obj
+
+class ReportCache:
+    """
+    نتائج التقارير المحسوبة (مجموعات iter_report) مع إخلاء الأقدم استخداماً (LRU) عند تجاوز
+    عدد النتائج أو مجموع الصفوف. المفتاح يشمل هوية قاعدة البيانات والفلاتر ونسخ البيانات، فلا تُعاد
+    نتيجة قديمة بعد أي تعديل أو استبدال لملف القاعدة. اختيارياً تُحفظ النتائج بصيغة JSON في مجلد على
+    القرص لتبقى بعد إعادة التشغيل وتشاركها العمليات.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()  # {المفتاح: (المجموعات، عدد الصفوف)}
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.disk_hits = self.misses = self.evictions = self.skipped = 0
+
+    def key(self, db, filters):
+        versions = get_data_versions(db, ('shipment',) + LOOKUP_TABLES)
+        identity = database_identity(db)
+        return hashlib.sha1(json.dumps([identity, filters, versions], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        groups = self._load(key)
+        with self._lock:
+            if groups is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(key, groups, sum(1 + len(items) for _, items, _ in groups))
+        return groups
+
+    def collect(self, key, groups):
+        """تمرير مجموعات التقرير وحفظها عند اكتمالها، ما لم تتجاوز الحد الأقصى للصفوف."""
+        collected = []
+        size = 0
+        limit = app.config['REPORT_CACHE_MAX_ROWS']
+        for group in groups:
+            yield group
+            if collected is not None:
+                collected.append(group)
+                size += 1 + len(group[1])
+                if size > limit:
+                    collected = None
+        if collected is None:
+            with self._lock:
+                self.skipped += 1
+            return
+        self._remember(key, collected, size)
+        self._store(key, collected)
+
+    def _remember(self, key, groups, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._rows -= old[1]
+            self._entries[key] = (groups, size)
+            self._rows += size
+            while len(self._entries) > app.config['REPORT_CACHE_ENTRIES'] or \
+                    self._rows > app.config['REPORT_CACHE_MAX_ROWS']:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._rows -= evicted_size
+                self.evictions += 1
+
+    def _path(self, key):
+        directory = app.config['REPORT_CACHE_DIR']
+        return os.path.join(directory, f'{key}.json') if directory else None
+
+    def _load(self, key):
+        path = self._path(key)
+        if not path or not os.path.exists(path):
+            return None
         try:
-            quantity = int(item['quantity'])
-            cost = int(item['cost'])
-            boxes_count = int(item['boxes_count'])
-            use_boxes = bool(item['use_boxes']) if 'use_boxes' in item.keys() else False
-            
-            # حساب كلفة الشحنة بناءً على قيمة use_boxes
-            item_cost = (boxes_count if use_boxes else quantity) * cost
-            
-            # إضافة إلى المجاميع
-            total_quantity += quantity
-            total_boxes += boxes_count
-            total_cost += item_cost
-        except Exception:
-            pass
-    
-    # تحويل Shipments إلى قائمة عادية بدل sqlite3.Row لمنع التكرار المحتمل
-    shipments_list = []
-    seen_ids = set()
-    for s in shipments:
-        if s['id'] not in seen_ids:
-            seen_ids.add(s['id'])
-            shipments_list.append(dict(s))
-    
-    return render_template('reports_monthly.html', 
-                         shipments=shipments_list, 
-                         items_by_shipment=items_by_shipment, 
-                         from_date=from_date, 
-                         to_date=to_date, 
-                         total_cost=total_cost,
-                         total_quantity=total_quantity,
-                         total_boxes=total_boxes)
+            with open(path, encoding='utf-8') as f:
+                return json.load(f, object_hook=_report_json_decode)
+        except (OSError, ValueError):
+            return None
 
-@app.route('/reports/monthly/export', methods=['POST'])
-def export_monthly_report():
-    from_date = request.form.get('from_date')
-    to_date = request.form.get('to_date')
-    with get_db() as db:
-        # تعديل الاستعلام ليكون بدون ربط shipment_item وضمان عدم تكرار الشحنات
-        # تعديل الترتيب ليكون تصاعديًا حسب تاريخ تسليم الشحنة
-        query = '''
-            SELECT DISTINCT s.id, s.*, c.name as carrier_company_name, g1.name as from_gov_name, g2.name as to_gov_name
-            FROM shipment s
-            LEFT JOIN carrier_company c ON s.carrier_company = c.name
-            LEFT JOIN governorate g1 ON s.from_governorate = g1.name
-            LEFT JOIN governorate g2 ON s.to_governorate = g2.name
-            WHERE 1=1
-        '''
-        params = []
-        if from_date:
-            query += ' AND date(s.delivery_date) >= ?'
-            params.append(from_date)
-        if to_date:
-            query += ' AND date(s.delivery_date) <= ?'
-            params.append(to_date)
-        # تعديل ترتيب النتائج ليكون تصاعديًا حسب تاريخ التسليم
-        query += ' GROUP BY s.id ORDER BY s.delivery_date ASC'
-        shipments = db.execute(query, params).fetchall()
-        
-        # جلب البنود بشكل منفصل
-        shipment_ids = [str(s['id']) for s in shipments]
-        items = []
-        if shipment_ids:
-            q = f"SELECT si.*, st.name as shipment_type_name, d.name as department_name FROM shipment_item si JOIN shipment_type st ON si.shipment_type_id=st.id JOIN department d ON si.department_id=d.id WHERE si.shipment_id IN ({','.join(['?']*len(shipment_ids))})"
-            items = db.execute(q, shipment_ids).fetchall()
-    
-    # تنظيم البنود حسب رقم الشحنة
-    items_by_shipment = {}
-    for item in items:
-        items_by_shipment.setdefault(item['shipment_id'], []).append(item)
-    
-    # حساب المجاميع
-    total_sum = 0
-    total_quantity = 0
-    total_boxes = 0
-    
-    for item in items:
+    def _store(self, key, groups):
+        path = self._path(key)
+        if not path:
+            return
+        directory = os.path.dirname(path)
         try:
-            quantity = int(item['quantity'])
-            cost = int(item['cost'])
-            boxes_count = int(item['boxes_count'])
-            use_boxes = bool(item['use_boxes']) if 'use_boxes' in item.keys() else False
-            
-            # حساب كلفة الشحنة بنفس طريقة النموذج
-            calculated_total = (boxes_count if use_boxes else quantity) * cost
-            
-            # إضافة إلى المجاميع
-            total_quantity += quantity
-            total_boxes += boxes_count
-            total_sum += calculated_total  # استخدام القيمة المحسوبة بدلاً من total المخزنة
-        except Exception:
-            pass
-    
-    # إنشاء ملف الإكسل
-    output = io.BytesIO()
+            os.makedirs(directory, exist_ok=True)
+            partial = f'{path}.{os.getpid()}.part'
+            with open(partial, 'w', encoding='utf-8') as f:
+                json.dump(groups, f, ensure_ascii=False, default=_report_json_encode)
+            os.replace(partial, path)
+            # الإبقاء على أحدث الملفات فقط (نتائج النسخ القديمة لن تُطابق أي مفتاح بعد الآن)
+            files = sorted((os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.endswith('.json')), key=os.path.getmtime, reverse=True)
+            for stale in files[app.config['REPORT_CACHE_DISK_ENTRIES']:]:
+                os.remove(stale)
+        except OSError:
+            app.logger.warning('report cache: could not write %s', path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'rows': self._rows,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'skipped_too_large': self.skipped,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 3) if lookups else None,
+            }
+
+report_cache = ReportCache()
+
+def report_groups(db, **filters):
+    """مجموعات التقرير من الذاكرة المؤقتة إن وجدت، وإلا من iter_report مع حفظها للطلبات التالية."""
+    filters = normalize_report_filters(filters)
+    key = report_cache.key(db, filters)
+    groups = report_cache.get(key)
+    if groups is not None:
+        return iter(groups)
+    return report_cache.collect(key, iter_report(db, **filters))
+
+def build_report(db, **filters):
+    """نتيجة التقرير كاملة لعرضها في قالب HTML."""
+    report = {
+        'shipments': [],
+        'items_by_shipment': {},
+        'total_quantity': 0,
+        'total_boxes': 0,
+        'total_cost': 0,
+    }
+    for shipment, items, totals in report_groups(db, **filters):
+        report['shipments'].append(shipment)
+        if items:
+            report['items_by_shipment'][shipment['id']] = items
+        report.update(totals)
+    return report
+
+def build_report_from_summary(summary):
+    """تقرير بدون تفاصيل الشحنات، مجاميعه مأخوذة من الملخص الشهري."""
+    return {
+        'shipments': [],
+        'items_by_shipment': {},
+        'total_quantity': sum(row['quantity'] for row in summary),
+        'total_boxes': sum(row['boxes'] for row in summary),
+        'total_cost': sum(row['cost'] for row in summary),
+    }
+
+def write_report_workbook(output, groups, title, total_label, from_date, to_date, include_empty=True):
+    """
+    كتابة تقرير الشحنات إلى ملف إكسل من نفس مولّد iter_report المستخدم في صفحات HTML.
+    include_empty: إظهار الشحنات التي لا تحتوي بنوداً (مطابقة) بسطر "لا يوجد بنود".
+    """
+    import xlsxwriter
     workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-    worksheet = workbook.add_worksheet('تقرير الشحنات الشهري')
+    worksheet = workbook.add_worksheet(title)
     worksheet.right_to_left()  # عرض الجدول من اليمين إلى اليسار
     # إعداد التنسيقات
     title_format = workbook.add_format({'bold': True, 'font_size': 18, 'align': 'center', 'valign': 'vcenter', 'font_color': '#1976d2'})
@@ -751,94 +2069,59 @@ def export_monthly_report():
     total_format = workbook.add_format({'bold': True, 'bg_color': '#ffe082', 'font_color': '#b26a00', 'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14})
     total_value_format = workbook.add_format({'bold': True, 'bg_color': '#fff8e1', 'font_color': '#b26a00', 'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14})
     # عنوان التقرير
-    worksheet.merge_range(0, 0, 0, 14, 'تقرير الشحنات الشهري', title_format)
+    worksheet.merge_range(0, 0, 0, 14, title, title_format)
     # تاريخ من وإلى
     date_range = f"من: {from_date or '-'}   إلى: {to_date or '-'}"
     worksheet.merge_range(1, 0, 1, 14, date_range, date_format)
-    # تعديل عناوين الأعمدة لتطابق النموذج
-    details_headers = ['صنف الشحنة', 'القسم', 'الكمية', 'التكلفة', 'عدد الكراتين', 'كلفة الشحنة', 'ملاحظات الشحنة']
     # رؤوس الأعمدة
     headers = [
         '#', 'رقم شحنة شركة النقل', 'تاريخ تسليم الشحنة', 'رقم وصل شحن جبال', 'رقم الأوردر',
-        'من', 'إلى', 'الشركة الناقلة',
-        'تفاصيل الشحنة'
+        'من', 'إلى', 'الشركة الناقلة'
     ]
+    details_headers = ['صنف الشحنة', 'القسم', 'الكمية', 'التكلفة', 'عدد الكراتين', 'كلفة الشحنة', 'ملاحظات الشحنة']
     # دمج الخلايا لرأس تفاصيل الشحنة فقط بعدد أعمدة التفاصيل (من 8 إلى 14)
     worksheet.merge_range(2, 8, 2, 14, 'تفاصيل الشحنة', details_header_format)
-    # كتابة رؤوس الأعمدة الأخرى
-    for col, h in enumerate(headers):
-        if col < 8:
-            worksheet.write(2, col, h, header_format)
-    
-    # كتابة عناوين تفاصيل الشحنة
-    for col, h in enumerate(details_headers):
-        worksheet.write(3, col + 8, h, details_header_format)
-    
-    # تعديل بداية الصفوف للبيانات
+    worksheet.write_row(2, 0, headers, header_format)
+    worksheet.write_row(3, 8, details_headers, details_header_format)
+
     row = 4
     row_num = 1
-    for s in shipments:
-        shipment_items = items_by_shipment.get(s['id'], [])
+    totals = {'total_quantity': 0, 'total_boxes': 0, 'total_cost': 0}
+    for s, shipment_items, totals in groups:
+        if not shipment_items and not include_empty:
+            continue
+        values = [
+            row_num, s['shopiny_number'], s['delivery_date'].strftime('%Y-%m-%d') if s['delivery_date'] else '',
+            s['receipt_number'], s['order_number'], s['from_gov_name'], s['to_gov_name'], s['carrier_company_name']
+        ]
         rowspan = len(shipment_items) if shipment_items else 1
-        if shipment_items:
-            # دمج خلايا الأعمدة الأساسية إذا كان هناك أكثر من بند
-            if rowspan > 1:
-                for col, value in enumerate([
-                    row_num, s['shopiny_number'], str(s['delivery_date'])[:10] if s['delivery_date'] else '',
-                    s['receipt_number'], s['order_number'], s['from_gov_name'], s['to_gov_name'], s['carrier_company_name']
-                ]):
-                    worksheet.merge_range(row, col, row + rowspan - 1, col, value, cell_format)
-            else:
-                for col, value in enumerate([
-                    row_num, s['shopiny_number'], str(s['delivery_date'])[:10] if s['delivery_date'] else '',
-                    s['receipt_number'], s['order_number'], s['from_gov_name'], s['to_gov_name'], s['carrier_company_name']
-                ]):
-                    worksheet.write(row, col, value, cell_format)
-            
-            for idx, item in enumerate(shipment_items):
-                item_row = row + idx
-                
-                # قراءة القيم مباشرة من البيانات
-                quantity = int(item['quantity'])
-                cost = int(item['cost'])
-                boxes_count = int(item['boxes_count'])
-                use_boxes = bool(item['use_boxes']) if 'use_boxes' in item.keys() else False
-                
-                # حساب كلفة الشحنة بنفس طريقة النموذج
-                calculated_total = (boxes_count if use_boxes else quantity) * cost
-                
-                # كتابة البيانات في الخلايا
-                worksheet.write(item_row, 8, item['shipment_type_name'], cell_format)  # صنف الشحنة
-                worksheet.write(item_row, 9, item['department_name'], cell_format)     # القسم
-                worksheet.write(item_row, 10, quantity, cell_format)                   # الكمية
-                worksheet.write(item_row, 11, cost, cell_format)                       # التكلفة
-                worksheet.write(item_row, 12, boxes_count, cell_format)                # عدد الكراتين
-                worksheet.write(item_row, 13, '{:,}'.format(calculated_total), cell_format)       # كلفة الشحنة
-                worksheet.write(item_row, 14, item['notes'], cell_format)              # ملاحظات الشحنة
-            
-            row += rowspan
-            row_num += 1
+        # دمج خلايا الأعمدة الأساسية إذا كان هناك أكثر من بند
+        if rowspan > 1:
+            for col, value in enumerate(values):
+                worksheet.merge_range(row, col, row + rowspan - 1, col, value, cell_format)
         else:
-            worksheet.write(row, 0, row_num, cell_format)
-            worksheet.write(row, 1, s['shopiny_number'], cell_format)
-            worksheet.write(row, 2, str(s['delivery_date'])[:10] if s['delivery_date'] else '', cell_format)
-            worksheet.write(row, 3, s['receipt_number'], cell_format)
-            worksheet.write(row, 4, s['order_number'], cell_format)
-            worksheet.write(row, 5, s['from_gov_name'], cell_format)
-            worksheet.write(row, 6, s['to_gov_name'], cell_format)
-            worksheet.write(row, 7, s['carrier_company_name'], cell_format)
+            worksheet.write_row(row, 0, values, cell_format)
+        if not shipment_items:
             worksheet.merge_range(row, 8, row, 14, 'لا يوجد بنود', cell_format)
-            row += 1
-            row_num += 1
-    
+        for idx, item in enumerate(shipment_items):
+            quantity = int(item['quantity'])
+            cost = int(item['cost'])
+            boxes_count = int(item['boxes_count'])
+            # حساب كلفة الشحنة بنفس طريقة النموذج
+            calculated_total = (boxes_count if item['use_boxes'] else quantity) * cost
+            worksheet.write_row(row + idx, 8, [
+                item['shipment_type_name'], item['department_name'], quantity, cost,
+                boxes_count, '{:,}'.format(calculated_total), item['notes']
+            ], cell_format)
+        row += rowspan
+        row_num += 1
+
     # صف المجموع الكلي (موحد)
-    worksheet.merge_range(row, 0, row, 9, 'المجموع الكلي:', total_format)
-    worksheet.write(row, 10, '{:,}'.format(total_quantity), total_value_format)  # الكمية
-    worksheet.write(row, 11, '', total_value_format)  # التكلفة (فارغة)
-    worksheet.write(row, 12, '{:,}'.format(total_boxes), total_value_format)  # عدد الكراتين
-    worksheet.write(row, 13, '{:,}'.format(total_sum), total_value_format)  # كلفة الشحنة
-    worksheet.write(row, 14, '', total_value_format)
-    
+    worksheet.merge_range(row, 0, row, 9, total_label, total_format)
+    worksheet.write_row(row, 10, [
+        '{:,}'.format(totals['total_quantity']), '',
+        '{:,}'.format(totals['total_boxes']), '{:,}'.format(totals['total_cost']), ''
+    ], total_value_format)
     # ضبط عرض الأعمدة
     worksheet.set_column(0, 0, 5)
     worksheet.set_column(1, 1, 18)
@@ -846,8 +2129,91 @@ def export_monthly_report():
     worksheet.set_column(3, 4, 15)
     worksheet.set_column(5, 7, 13)
     worksheet.set_column(8, 14, 13)
-    
     workbook.close()
+
+@app.route('/reports/monthly', methods=['GET', 'POST'])
+@conditional_get('shipment', *LOOKUP_TABLES)
+def reports_monthly():
+    # النموذج يُرسل بـ GET حتى تُطبق ETag والرد 304، ويبقى POST مقبولاً كما كان
+    from_date = request.values.get('from_date')
+    to_date = request.values.get('to_date')
+    summary_only = bool(request.values.get('summary_only'))
+    summary = []
+    with get_db() as db:
+        if from_date and to_date:
+            summary = monthly_summary(db, from_date, to_date)
+        if summary_only:
+            # الملخص فقط: قراءة صفوف المجاميع دون مسح الشحنات
+            report = build_report_from_summary(summary)
+        else:
+            report = build_report(db, from_date=from_date, to_date=to_date)
+    return render_template('reports_monthly.html',
+                         from_date=from_date,
+                         to_date=to_date,
+                         summary_only=summary_only,
+                         monthly_summary=summary,
+                         **report)
+
+def track_progress(groups, progress, every=500):
+    """تمرير مجموعات التقرير كما هي مع إبلاغ progress بعدد الشحنات المكتوبة كل every شحنة."""
+    count = 0
+    for group in groups:
+        yield group
+        count += 1
+        if progress and count % every == 0:
+            progress(count)
+    if progress:
+        progress(count)
+
+def write_monthly_summary_workbook(output, summary, from_date, to_date):
+    """كتابة الملخص الشهري (بدون تفاصيل الشحنات) إلى ملف إكسل."""
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    worksheet = workbook.add_worksheet('الملخص الشهري')
+    worksheet.right_to_left()
+    title_format = workbook.add_format({'bold': True, 'font_size': 18, 'align': 'center', 'valign': 'vcenter', 'font_color': '#1976d2'})
+    date_format = workbook.add_format({'font_size': 12, 'align': 'center', 'valign': 'vcenter', 'font_color': '#333'})
+    header_format = workbook.add_format({'bold': True, 'bg_color': '#2196F3', 'font_color': 'white', 'border': 1, 'align': 'center', 'valign': 'vcenter'})
+    cell_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1})
+    total_format = workbook.add_format({'bold': True, 'bg_color': '#ffe082', 'font_color': '#b26a00', 'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14})
+    total_value_format = workbook.add_format({'bold': True, 'bg_color': '#fff8e1', 'font_color': '#b26a00', 'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14})
+    worksheet.merge_range(0, 0, 0, 4, 'الملخص الشهري للشحنات', title_format)
+    worksheet.merge_range(1, 0, 1, 4, f"من: {from_date or '-'}   إلى: {to_date or '-'}", date_format)
+    worksheet.write_row(2, 0, ['الشهر', 'عدد البنود', 'الكمية', 'عدد الكراتين', 'كلفة الشحنة'], header_format)
+    row = 3
+    for m in summary:
+        worksheet.write_row(row, 0, [m['month'], m['item_count'], m['quantity'], m['boxes'],
+                                     '{:,}'.format(m['cost'])], cell_format)
+        row += 1
+    report = build_report_from_summary(summary)
+    worksheet.merge_range(row, 0, row, 1, 'المجموع الكلي:', total_format)
+    worksheet.write_row(row, 2, [
+        '{:,}'.format(report['total_quantity']), '{:,}'.format(report['total_boxes']),
+        '{:,}'.format(report['total_cost'])
+    ], total_value_format)
+    worksheet.set_column(0, 4, 15)
+    workbook.close()
+
+def write_monthly_report(output, params, progress=None):
+    with get_db() as db:
+        if params.get('summary_only'):
+            # الملخص فقط: نفس مجاميع صفحة التقرير دون مسح الشحنات
+            summary = monthly_summary(db, params['from_date'], params['to_date'])
+            write_monthly_summary_workbook(output, summary, params['from_date'], params['to_date'])
+            if progress:
+                progress(len(summary))
+            return
+        groups = report_groups(db, from_date=params['from_date'], to_date=params['to_date'])
+        write_report_workbook(output, track_progress(groups, progress), 'تقرير الشحنات الشهري',
+                              'المجموع الكلي:', params['from_date'], params['to_date'])
+
+@app.route('/reports/monthly/export', methods=['POST'])
+def export_monthly_report():
+    params = export_params('monthly')
+    if wants_export_job():
+        return export_job_response('monthly', params)
+    output = io.BytesIO()
+    write_monthly_report(output, params)
     output.seek(0)
     return send_file(output, download_name='monthly_report.xlsx', as_attachment=True)
 
@@ -858,262 +2224,40 @@ def reports_by():
     carrier_company = request.form.get('carrier_company')
     shipment_type = request.form.get('shipment_type')
     department = request.form.get('department')
-    shipments = []
-    items = []
     with get_db() as db:
         # جلب القوائم المنسدلة
-        carrier_companies = db.execute('SELECT name FROM carrier_company').fetchall()
-        shipment_types = db.execute('SELECT id, name FROM shipment_type').fetchall()
-        departments = db.execute('SELECT id, name FROM department').fetchall()
-        query = '''
-            SELECT s.*, c.name as carrier_company_name, g1.name as from_gov_name, g2.name as to_gov_name
-            FROM shipment s
-            LEFT JOIN carrier_company c ON s.carrier_company = c.name
-            LEFT JOIN governorate g1 ON s.from_governorate = g1.name
-            LEFT JOIN governorate g2 ON s.to_governorate = g2.name
-            WHERE 1=1
-        '''
-        params = []
-        if from_date:
-            query += ' AND date(s.delivery_date) >= ?'
-            params.append(from_date)
-        if to_date:
-            query += ' AND date(s.delivery_date) <= ?'
-            params.append(to_date)
-        if carrier_company:
-            query += ' AND s.carrier_company = ?'
-            params.append(carrier_company)
-        query += ' ORDER BY s.delivery_date ASC'  # تعديل الترتيب ليكون تصاعديًا حسب التاريخ
-        shipments = db.execute(query, params).fetchall()
-        shipment_ids = [str(s['id']) for s in shipments]
-        items = []
-        if shipment_ids:
-            item_query = '''SELECT si.*, st.name as shipment_type_name, d.name as department_name FROM shipment_item si \
-                JOIN shipment_type st ON si.shipment_type_id=st.id \
-                JOIN department d ON si.department_id=d.id \
-                WHERE si.shipment_id IN ({})'''.format(','.join(['?']*len(shipment_ids)))
-            item_params = shipment_ids
-            # فلترة البنود حسب الصنف أو القسم
-            if shipment_type:
-                item_query += ' AND si.shipment_type_id = ?'
-                item_params.append(shipment_type)
-            if department:
-                item_query += ' AND si.department_id = ?'
-                item_params.append(department)
-            items = db.execute(item_query, item_params).fetchall()
-    
-    items_by_shipment = {}
-    total_cost = 0
-    total_quantity = 0
-    total_boxes = 0
-    
-    for item in items:
-        items_by_shipment.setdefault(item['shipment_id'], []).append(item)
-        try:
-            quantity = int(item['quantity'])
-            cost = int(item['cost'])
-            boxes_count = int(item['boxes_count'])
-            use_boxes = bool(item['use_boxes']) if 'use_boxes' in item.keys() else False
-            
-            # حساب كلفة الشحنة بناءً على قيمة use_boxes
-            item_cost = (boxes_count if use_boxes else quantity) * cost
-            
-            # إضافة إلى المجاميع
-            total_quantity += quantity
-            total_boxes += boxes_count
-            total_cost += item_cost
-        except Exception:
-            pass
-    
-    return render_template('reports_by.html', 
-                         shipments=shipments, 
-                         items_by_shipment=items_by_shipment, 
-                         from_date=from_date, 
-                         to_date=to_date, 
-                         total_cost=total_cost,
-                         total_quantity=total_quantity,
-                         total_boxes=total_boxes,
-                         carrier_companies=carrier_companies, 
-                         shipment_types=shipment_types, 
-                         departments=departments, 
-                         selected_carrier=carrier_company, 
-                         selected_type=shipment_type, 
-                         selected_dept=department)
+        lookups = get_lookups(db, 'carrier_company', 'shipment_type', 'department')
+        carrier_companies = lookups['carrier_company']
+        shipment_types = lookups['shipment_type']
+        departments = lookups['department']
+        report = build_report(db, from_date=from_date, to_date=to_date, carrier_company=carrier_company,
+                              shipment_type=shipment_type, department=department)
+    return render_template('reports_by.html',
+                         from_date=from_date,
+                         to_date=to_date,
+                         carrier_companies=carrier_companies,
+                         shipment_types=shipment_types,
+                         departments=departments,
+                         selected_carrier=carrier_company,
+                         selected_type=shipment_type,
+                         selected_dept=department,
+                         **report)
+
+def write_by_report(output, params, progress=None):
+    with get_db() as db:
+        groups = report_groups(db, **params)
+        # إزالة الشحنات التي لا تحتوي على بنود متطابقة مع الفلتر
+        write_report_workbook(output, track_progress(groups, progress), 'تقرير الشحنات',
+                              'مجموع تكلفة النقل الكلية:', params['from_date'], params['to_date'],
+                              include_empty=False)
 
 @app.route('/reports/by/export', methods=['POST'])
 def export_by_report():
-    from_date = request.form.get('from_date')
-    to_date = request.form.get('to_date')
-    carrier_company = request.form.get('carrier_company')
-    shipment_type = request.form.get('shipment_type')
-    department = request.form.get('department')
-    with get_db() as db:
-        query = '''
-            SELECT s.*, c.name as carrier_company_name, g1.name as from_gov_name, g2.name as to_gov_name
-            FROM shipment s
-            LEFT JOIN carrier_company c ON s.carrier_company = c.name
-            LEFT JOIN governorate g1 ON s.from_governorate = g1.name
-            LEFT JOIN governorate g2 ON s.to_governorate = g2.name
-            WHERE 1=1
-        '''
-        params = []
-        if from_date:
-            query += ' AND date(s.delivery_date) >= ?'
-            params.append(from_date)
-        if to_date:
-            query += ' AND date(s.delivery_date) <= ?'
-            params.append(to_date)
-        if carrier_company:
-            query += ' AND s.carrier_company = ?'
-            params.append(carrier_company)
-        query += ' ORDER BY s.delivery_date ASC'
-        shipments = db.execute(query, params).fetchall()
-        
-        # استعلام للحصول على البنود التي تتطابق مع الفلتر
-        shipment_ids = [str(s['id']) for s in shipments]
-        items = []
-        if shipment_ids:
-            item_query = '''SELECT si.*, st.name as shipment_type_name, d.name as department_name FROM shipment_item si \
-                JOIN shipment_type st ON si.shipment_type_id=st.id \
-                JOIN department d ON si.department_id=d.id \
-                WHERE si.shipment_id IN ({})'''.format(','.join(['?']*len(shipment_ids)))
-            item_params = shipment_ids
-            if shipment_type:
-                item_query += ' AND si.shipment_type_id = ?'
-                item_params.append(shipment_type)
-            if department:
-                item_query += ' AND si.department_id = ?'
-                item_params.append(department)
-            items = db.execute(item_query, item_params).fetchall()
-    
-    # تنظيم البنود حسب رقم الشحنة
-    items_by_shipment = {}
-    total_sum = 0
-    total_quantity = 0
-    total_boxes = 0
-    
-    for item in items:
-        items_by_shipment.setdefault(item['shipment_id'], []).append(item)
-        # حساب القيم الكلية باستخدام حقل total المخزن مباشرة
-        try:
-            quantity = int(item['quantity'])
-            boxes_count = int(item['boxes_count'])
-            total = int(item['total'])
-            
-            # إضافة إلى المجاميع
-            total_quantity += quantity
-            total_boxes += boxes_count
-            total_sum += total  # استخدام قيمة total المخزنة مباشرة
-        except Exception:
-            pass
-    
-    # إزالة الشحنات التي لا تحتوي على بنود متطابقة مع الفلتر
-    filtered_shipments = []
-    for s in shipments:
-        if s['id'] in items_by_shipment:
-            filtered_shipments.append(s)
-    
-    # إنشاء ملف الإكسل
+    params = export_params('by')
+    if wants_export_job():
+        return export_job_response('by', params)
     output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-    worksheet = workbook.add_worksheet('تقرير الشحنات')
-    worksheet.right_to_left()
-    
-    # إعداد التنسيقات
-    title_format = workbook.add_format({'bold': True, 'font_size': 18, 'align': 'center', 'valign': 'vcenter', 'font_color': '#1976d2'})
-    date_format = workbook.add_format({'font_size': 12, 'align': 'center', 'valign': 'vcenter', 'font_color': '#333'})
-    header_format = workbook.add_format({'bold': True, 'bg_color': '#2196F3', 'font_color': 'white', 'border': 1, 'align': 'center', 'valign': 'vcenter'})
-    details_header_format = workbook.add_format({'bold': True, 'bg_color': '#ffe0b2', 'font_color': '#b26a00', 'border': 1, 'align': 'center', 'valign': 'vcenter'})
-    cell_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1})
-    total_format = workbook.add_format({'bold': True, 'bg_color': '#ffe082', 'font_color': '#b26a00', 'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14})
-    total_value_format = workbook.add_format({'bold': True, 'bg_color': '#fff8e1', 'font_color': '#b26a00', 'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14})
-    
-    # عنوان التقرير
-    worksheet.merge_range(0, 0, 0, 14, 'تقرير الشحنات', title_format)
-    
-    # تاريخ من وإلى
-    date_range = f"من: {from_date or '-'}   إلى: {to_date or '-'}"
-    worksheet.merge_range(1, 0, 1, 14, date_range, date_format)
-    
-    # تعديل عناوين الأعمدة لتطابق النموذج
-    details_headers = ['صنف الشحنة', 'الكمية', 'التكلفة', 'عدد الصناديق', 'الإجمالي', 'ملاحظات الشحنة']
-    
-    # دمج الخلايا لرأس تفاصيل الشحنة فقط بعدد أعمدة التفاصيل (من 8 إلى 14)
-    worksheet.merge_range(2, 8, 2, 14, 'تفاصيل الشحنة', details_header_format)
-    
-    # رؤوس الأعمدة الأساسية
-    headers = [
-        '#', 'رقم شحنة شركة النقل', 'تاريخ تسليم الشحنة', 'رقم وصل شحن جبال', 'رقم الأوردر',
-        'من', 'إلى', 'الشركة الناقلة'
-    ]
-    
-    # كتابة رؤوس الأعمدة الأساسية
-    for col, h in enumerate(headers):
-        worksheet.write(2, col, h, header_format)
-    
-    # كتابة عناوين تفاصيل الشحنة
-    for col, h in enumerate(details_headers):
-        worksheet.write(3, col + 8, h, details_header_format)
-    
-    row = 4
-    row_num = 1
-    
-    for s in filtered_shipments:
-        shipment_items = items_by_shipment.get(s['id'], [])
-        rowspan = len(shipment_items)
-        
-        # دمج خلايا الأعمدة الأساسية إذا كان هناك أكثر من بند
-        if rowspan > 1:
-            for col, value in enumerate([
-                row_num, s['shopiny_number'], str(s['delivery_date'])[:10] if s['delivery_date'] else '',
-                s['receipt_number'], s['order_number'], s['from_gov_name'], s['to_gov_name'], s['carrier_company_name']
-            ]):
-                worksheet.merge_range(row, col, row + rowspan - 1, col, value, cell_format)
-        else:
-            for col, value in enumerate([
-                row_num, s['shopiny_number'], str(s['delivery_date'])[:10] if s['delivery_date'] else '',
-                s['receipt_number'], s['order_number'], s['from_gov_name'], s['to_gov_name'], s['carrier_company_name']
-            ]):
-                worksheet.write(row, col, value, cell_format)
-        
-        for idx, item in enumerate(shipment_items):
-            item_row = row + idx
-            
-            # حساب قيم العرض
-            quantity = int(item['quantity'])
-            cost = int(item['cost'])
-            boxes_count = int(item['boxes_count'])
-            use_boxes = bool(item['use_boxes']) if 'use_boxes' in item.keys() else False
-            
-            # حساب كلفة الشحنة بنفس طريقة النموذج
-            calculated_total = (boxes_count if use_boxes else quantity) * cost
-            
-            # كتابة البيانات في الخلايا
-            worksheet.write(item_row, 8, item['shipment_type_name'], cell_format)  # صنف الشحنة
-            worksheet.write(item_row, 9, item['department_name'], cell_format)     # القسم
-            worksheet.write(item_row, 10, quantity, cell_format)                   # الكمية
-            worksheet.write(item_row, 11, cost, cell_format)                       # التكلفة
-            worksheet.write(item_row, 12, boxes_count, cell_format)                # عدد الكراتين
-            worksheet.write(item_row, 13, '{:,}'.format(calculated_total), cell_format)       # كلفة الشحنة
-            worksheet.write(item_row, 14, item['notes'], cell_format)              # ملاحظات الشحنة
-        
-        row += rowspan
-        row_num += 1
-    
-    # صف المجموع الكلي (موحد)
-    worksheet.merge_range(row, 0, row, 9, 'مجموع تكلفة النقل الكلية:', total_format)
-    worksheet.write(row, 10, '{:,}'.format(total_quantity), total_value_format)  # الكمية
-    worksheet.write(row, 11, '', total_value_format)  # التكلفة (فارغة)
-    worksheet.write(row, 12, '{:,}'.format(total_boxes), total_value_format)  # عدد الكراتين
-    worksheet.write(row, 13, '{:,}'.format(total_sum), total_value_format)  # كلفة الشحنة
-    worksheet.write(row, 14, '', total_value_format)
-    worksheet.set_column(0, 0, 5)
-    worksheet.set_column(1, 1, 18)
-    worksheet.set_column(2, 2, 15)
-    worksheet.set_column(3, 4, 15)
-    worksheet.set_column(5, 7, 13)
-    worksheet.set_column(8, 14, 13)
-    workbook.close()
+    write_by_report(output, params)
     output.seek(0)
     return send_file(output, download_name='shipments_report.xlsx', as_attachment=True)
 
@@ -1125,10 +2269,11 @@ def api_generate_shopiny_number():
         number = generate_shopiny_number(db, governorate, delivery_date)
     return {'shopiny_number': number}
 
-def generate_shopiny_number(db, governorate, delivery_date):
+def generate_shopiny_number(db, governorate, delivery_date, allocate=False):
     """
     توليد رقم وصل شحن جبال: اسم المحافظة + اخر رقمين من السنة + رقمين من الشهر + رقم تسلسلي 4 مراتب
-    مع التأكد من عدم تكرار الرقم في قاعدة البيانات
+    الرقم التسلسلي يؤخذ من جدول receipt_counter: بدون allocate يعيد الرقم التالي للمعاينة فقط،
+    ومع allocate=True يحجزه بشكل ذري (يجب استدعاؤه داخل معاملة كتابة).
     """
     if not governorate or not delivery_date:
         return ''
@@ -1141,75 +2286,544 @@ def generate_shopiny_number(db, governorate, delivery_date):
         return ''
     year_part = str(dt.year)[-2:]
     month_part = f'{dt.month:02d}'
-    # احسب الرقم التسلسلي لهذا الشهر والمحافظة بناءً على receipt_number
-    serial_query = '''SELECT receipt_number FROM shipment WHERE from_governorate = ? AND strftime('%Y-%m', delivery_date) = ? AND receipt_number IS NOT NULL AND receipt_number != '' ORDER BY id DESC LIMIT 1'''
-    last = db.execute(serial_query, [governorate, dt.strftime('%Y-%m')]).fetchone()
-    if last and last['receipt_number']:
-        try:
-            last_serial = int(last['receipt_number'][-4:])
-        except Exception:
-            last_serial = 0
-    else:
-        last_serial = 0
-    
-    # البدء بالرقم التسلسلي التالي للآخر المستخدم
-    new_serial = last_serial + 1
-    
-    # التأكد من أن الرقم المُنشأ غير موجود بالفعل في قاعدة البيانات
-    while True:
-        serial_part = f'{new_serial:04d}'
-        generated_number = f'{gov_part}{year_part}{month_part}{serial_part}'
-        
-        # التحقق من وجود هذا الرقم في قاعدة البيانات
-        existing = db.execute('SELECT id FROM shipment WHERE receipt_number = ?', [generated_number]).fetchone()
-        if not existing:
-            # الرقم غير موجود، يمكن استخدامه
-            break
-            
-        # إذا كان الرقم موجودًا، جرب الرقم التالي
-        new_serial += 1
-        
-        # منع الحلقة اللانهائية في حالة وجود مشاكل غير متوقعة
-        if new_serial > last_serial + 1000:  # حد أقصى معقول
-            break
-    
-    return generated_number
+    month = dt.strftime('%Y-%m')
+    if not allocate:
+        row = db.execute('SELECT last_serial FROM receipt_counter WHERE governorate = ? AND month = ?',
+                         [governorate, month]).fetchone()
+        return f'{gov_part}{year_part}{month_part}{(row[0] if row else 0) + 1:04d}'
+    # أعلى رقم تسلسلي مستخدم فعلاً بهذه البادئة (قد تُدخل أرقام يدوياً خارج العداد)، باستعلام
+    # واحد على نطاق من فهرس receipt_number بدل فحص الأرقام واحداً تلو الآخر داخل قفل الكتابة
+    prefix = f'{gov_part}{year_part}{month_part}'
+    used = db.execute('''
+        SELECT MAX(CAST(substr(receipt_number, ?) AS INTEGER)) FROM shipment
+        WHERE receipt_number BETWEEN ? AND ? AND substr(receipt_number, ?) GLOB '[0-9][0-9][0-9][0-9]'
+    ''', [len(prefix) + 1, f'{prefix}0000', f'{prefix}9999', len(prefix) + 1]).fetchone()[0] or 0
+    serial = db.execute('''
+        INSERT INTO receipt_counter (governorate, month, last_serial) VALUES (?, ?, ?)
+        ON CONFLICT (governorate, month) DO UPDATE SET last_serial = MAX(last_serial, ?) + 1
+        RETURNING last_serial
+    ''', [governorate, month, used + 1, used]).fetchone()[0]
+    return f'{prefix}{serial:04d}'
 
-@app.route('/export-all')
-def export_all():
+def seed_receipt_counters(db, shipment_id=None):
     """
-    Export all tables to a single Excel file (each table as a sheet).
+    مزامنة receipt_counter مع أرقام الوصولات الموجودة (آخر 4 مراتب من receipt_number)،
+    لكل الشحنات أو لشحنة واحدة بعد تعديلها. لا ينقص العداد أبداً.
     """
-    output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    where = 'id = ?' if shipment_id is not None else '1=1'
+    db.execute(f'''
+        INSERT INTO receipt_counter (governorate, month, last_serial)
+        SELECT from_governorate, substr(delivery_date, 1, 7), MAX(CAST(substr(receipt_number, -4) AS INTEGER))
+        FROM shipment
+        WHERE {where} AND receipt_number IS NOT NULL AND receipt_number != '' AND delivery_date IS NOT NULL
+        GROUP BY 1, 2
+        ON CONFLICT (governorate, month) DO UPDATE SET last_serial = MAX(last_serial, excluded.last_serial)
+    ''', [shipment_id] if shipment_id is not None else [])
+
+# الجداول المشمولة في التصدير والاستيراد الكامل
+EXPORT_TABLES = [
+    'shipment', 'shipment_item', 'shipment_type',
+    'department', 'carrier_company', 'governorate'
+]
+EXPORT_CHUNK_SIZE = 2000
+
+def iter_table_chunks(db, table, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    يعيد (أسماء الأعمدة، مولّد دفعات الصفوف) دون تحميل الجدول كاملاً في الذاكرة.
+    أعمدة DATETIME تُقرأ كنص كما هي مخزنة (CAST يلغي المحول) حتى يبقى التصدير مطابقاً للقاعدة.
+    """
+    columns = [f'CAST({row["name"]} AS TEXT) AS {row["name"]}' if row['type'].upper() == 'DATETIME' else row['name']
+               for row in db.execute(f'PRAGMA table_info({table})')]
+    cursor = db.execute(f'SELECT {", ".join(columns)} FROM {table}')
+    headers = [column[0] for column in cursor.description]
+
+    def chunks():
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    return headers, chunks()
+
+def write_all_workbook(output, params=None, progress=None):
+    """
+    كتابة كل الجداول إلى ملف إكسل واحد (كل جدول في ورقة) على دفعات في وضع constant_memory.
+    progress(الصفوف المكتوبة، مجموع الصفوف) يُستدعى بعد كل دفعة.
+    """
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
     with get_db() as db:
-        tables = [
-            'shipment', 'shipment_item', 'shipment_type',
-            'department', 'carrier_company', 'governorate'
-        ]
-        for table in tables:
+        rows_total = None
+        if progress:
+            rows_total = sum(db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in EXPORT_TABLES)
+        written = 0
+        for table in EXPORT_TABLES:
             worksheet = workbook.add_worksheet(table)
-            rows = db.execute(f"SELECT * FROM {table}").fetchall()
-            if not rows:
-                continue
-            # Write headers
-            headers = rows[0].keys()
-            for col, h in enumerate(headers):
-                worksheet.write(0, col, h)
-            # Write data
-            for row_idx, row in enumerate(rows, 1):
-                for col, h in enumerate(headers):
-                    worksheet.write(row_idx, col, row[h])
+            headers, chunks = iter_table_chunks(db, table)
+            row_idx = 0
+            for rows in chunks:
+                if row_idx == 0:
+                    worksheet.write_row(0, 0, headers)
+                    row_idx = 1
+                for row in rows:
+                    worksheet.write_row(row_idx, 0, tuple(row))
+                    row_idx += 1
+                written += len(rows)
+                if progress:
+                    progress(written, rows_total)
     workbook.close()
+
+@app.route('/export-all', methods=['GET', 'POST'])
+def export_all():
+    """
+    Export all tables to a single Excel file (each table as a sheet).
+    الملف يُكتب إلى ملف مؤقت يُرسل بعدها للمتصفح، أو كمهمة في الخلفية عند طلبها من الواجهة.
+    """
+    if wants_export_job():
+        return export_job_response('all', {})
+    output = tempfile.TemporaryFile()
+    write_all_workbook(output)
     output.seek(0)
-    return send_file(output, download_name='all_data.xlsx', as_attachment=True)
+    return send_file(output, download_name='all_data.xlsx', as_attachment=True,
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+class _ZipStream(io.RawIOBase):
+    """مخزن كتابة مؤقت لملف zip يُفرَّغ إلى الاستجابة بعد كل دفعة."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+@app.route('/export-all/csv')
+def export_all_csv():
+    """
+    Export all tables as CSV files inside a zip archive, streamed while it is built.
+    """
+    def generate():
+        stream = _ZipStream()
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with get_db() as db:
+                for table in EXPORT_TABLES:
+                    headers, chunks = iter_table_chunks(db, table)
+                    with archive.open(f'{table}.csv', 'w') as entry:
+                        # utf-8-sig ليفتح Excel النصوص العربية بشكل صحيح
+                        with io.TextIOWrapper(entry, encoding='utf-8-sig', newline='') as text:
+                            writer = csv.writer(text)
+                            writer.writerow(headers)
+                            for rows in chunks:
+                                writer.writerows(rows)
+                                text.flush()
+                                yield stream.drain()
+                    yield stream.drain()
+        yield stream.drain()
+
+    return Response(perf_stream(generate()), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=all_data_csv.zip'})
+
+# أنواع مهام التصدير: (دالة الكتابة، اسم الملف عند التنزيل، حقول النموذج المعتمدة)
+EXPORT_JOB_KINDS = {
+    'all': (write_all_workbook, 'all_data.xlsx', ()),
+    'monthly': (write_monthly_report, 'monthly_report.xlsx', ('from_date', 'to_date', 'summary_only')),
+    'by': (write_by_report, 'shipments_report.xlsx',
+           ('from_date', 'to_date', 'carrier_company', 'shipment_type', 'department')),
+}
+# أقل فاصل زمني (ثوانٍ) بين تحديثات التقدم حتى لا تزاحم عمليات الكتابة الأخرى
+EXPORT_JOB_PROGRESS_INTERVAL = 1.0
+
+_export_executor = None
+_export_executor_pid = None
+_export_executor_lock = threading.Lock()
+_export_owner = None  # (pid، هوية العملية في عمود owner)
+_export_active = 0  # مهام هذه العملية التي لم تنته بعد
+_export_heartbeat_thread = None
+
+def export_job_owner():
+    """هوية هذه العملية (الجهاز:pid:رمز عشوائي) حتى لا تُخلط بعملية سابقة أخذت نفس pid."""
+    global _export_owner
+    if _export_owner is None or _export_owner[0] != os.getpid():
+        _export_owner = (os.getpid(), f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}')
+    return _export_owner[1]
+
+def get_export_executor():
+    """مجمّع خيوط التصدير الخاص بهذه العملية (يُنشأ من جديد بعد fork)."""
+    global _export_executor, _export_executor_pid, _export_active, _export_heartbeat_thread
+    with _export_executor_lock:
+        if _export_executor is None or _export_executor_pid != os.getpid():
+            _export_executor = ThreadPoolExecutor(max_workers=app.config['EXPORT_JOB_WORKERS'],
+                                                  thread_name_prefix='export-job')
+            _export_executor_pid = os.getpid()
+            _export_active = 0
+            _export_heartbeat_thread = None
+        return _export_executor
+
+def export_job_started():
+    """عدّ مهمة جديدة في هذه العملية، وتشغيل خيط الإشارات الدورية إن لم يكن يعمل."""
+    global _export_active, _export_heartbeat_thread
+    with _export_executor_lock:
+        _export_active += 1
+        if _export_heartbeat_thread is None:
+            _export_heartbeat_thread = threading.Thread(target=_export_heartbeat, name='export-job-heartbeat',
+                                                        daemon=True)
+            _export_heartbeat_thread.start()
+
+def export_job_finished():
+    global _export_active
+    with _export_executor_lock:
+        _export_active -= 1
+
+def track_export_job(job_id):
+    """تنفيذ المهمة ضمن عدّاد المهام الجارية في هذه العملية."""
+    try:
+        run_export_job(job_id)
+    finally:
+        export_job_finished()
+
+def _export_heartbeat():
+    # يعمل فقط ما دامت في هذه العملية مهام لم تنته، ثم ينتهي حتى لا يحجز قفل الكتابة دون حاجة
+    global _export_heartbeat_thread
+    owner = export_job_owner()
+    while True:
+        time.sleep(app.config['EXPORT_JOB_HEARTBEAT'])
+        with _export_executor_lock:
+            if _export_active <= 0:
+                _export_heartbeat_thread = None
+                return
+        try:
+            with get_db(write=True) as db:
+                db.execute('''
+                    UPDATE export_job SET heartbeat_at = ? WHERE owner = ? AND status IN ('pending', 'running')
+                ''', [datetime.now(), owner])
+                expired = cleanup_export_jobs(db)
+            remove_export_files(expired)
+        except sqlite3.Error:
+            app.logger.warning('export job heartbeat failed', exc_info=True)
+
+def export_job_alive(job, now):
+    """هل ما زالت عملية المهمة (المعلقة أو الجارية) حية؟ إشارة حديثة، ولم تنته عمليتها على هذا الجهاز."""
+    heartbeat = job['heartbeat_at'] or job['created_at']
+    if now - heartbeat > timedelta(seconds=app.config['EXPORT_JOB_STALE_AFTER']):
+        return False
+    if not job['owner']:
+        return False
+    host, pid, _ = job['owner'].rsplit(':', 2)
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return job['owner'] == export_job_owner()
+    if os.name == 'nt':
+        # os.kill على ويندوز ينهي العملية بدل فحصها؛ نكتفي بالإشارة الدورية
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def fail_export_job(db, job_id, error, now):
+    db.execute('''
+        UPDATE export_job SET status = 'failed', error = ?, finished_at = ?, expires_at = ?
+        WHERE id = ? AND status IN ('pending', 'running')
+    ''', [error, now, now + timedelta(seconds=app.config['EXPORT_JOB_TTL']), job_id])
+
+def cleanup_export_jobs(db):
+    """
+    حذف المهام المنتهية صلاحيتها وتعليم المهام المتوقفة كفاشلة (ضمن معاملة كتابة).
+    يعيد مسارات الملفات الواجب حذفها بعد إنهاء المعاملة.
+    """
+    now = datetime.now()
+    expired = [row['file_path'] for row in db.execute(
+        'SELECT file_path FROM export_job WHERE expires_at <= ?', [now]) if row['file_path']]
+    db.execute('DELETE FROM export_job WHERE expires_at <= ?', [now])
+    for job in db.execute("SELECT * FROM export_job WHERE status IN ('pending', 'running')").fetchall():
+        if not export_job_alive(job, now):
+            fail_export_job(db, job['id'], 'interrupted', now)
+    return expired
+
+def remove_export_files(paths):
+    for path in paths:
+        remove_file(path)
+        remove_file(path + '.part')
+
+def export_job_dir():
+    return app.config['EXPORT_JOB_DIR'] or os.path.join(
+        os.path.dirname(os.path.abspath(app.config['DATABASE'])), 'exports')
+
+def wants_export_job():
+    # الواجهة ترسل هذا الترويسة عند توفر JavaScript؛ بدونها يبقى التصدير المباشر كما كان
+    return request.headers.get('X-Export-Job') == '1'
+
+def export_params(kind):
+    return {field: request.form.get(field) or None for field in EXPORT_JOB_KINDS[kind][2]}
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def submit_export_job(kind, params):
+    """
+    تسجيل مهمة تصدير وإرسالها للتنفيذ في الخلفية، ويعيد رقمها. المهمة المطابقة (نفس النوع
+    والمعاملات ونسخة البيانات) التي ما زالت تعمل أو انتهت ولم تنته صلاحيتها تُعاد بدل إنشاء مهمة
+    جديدة؛ المهام المتوقفة تُعلَّم كفاشلة ولا تُعاد.
+    """
+    now = datetime.now()
+    owner = export_job_owner()
+    with get_db(write=True) as db:
+        expired = cleanup_export_jobs(db)
+        versions = get_data_versions(db, ('shipment',) + LOOKUP_TABLES)
+        job_key = hashlib.sha1(json.dumps([kind, params, versions], sort_keys=True).encode()).hexdigest()
+        existing = db.execute('''
+            SELECT id FROM export_job
+            WHERE job_key = ? AND status IN ('pending', 'running', 'done')
+            ORDER BY created_at DESC LIMIT 1
+        ''', [job_key]).fetchone()
+        if existing:
+            job_id = existing['id']
+        else:
+            job_id = uuid.uuid4().hex
+            db.execute('''
+                INSERT INTO export_job (id, kind, params, job_key, owner, created_at, heartbeat_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [job_id, kind, json.dumps(params), job_key, owner, now, now])
+    remove_export_files(expired)
+    if not existing:
+        executor = get_export_executor()
+        export_job_started()
+        executor.submit(track_export_job, job_id)
+    return job_id
+
+def run_export_job(job_id):
+    owner = export_job_owner()
+    with get_db(write=True) as db:
+        job = db.execute("SELECT * FROM export_job WHERE id = ? AND status = 'pending' AND owner = ?",
+                         [job_id, owner]).fetchone()
+        if job is None:
+            return
+        db.execute("UPDATE export_job SET status = 'running', heartbeat_at = ? WHERE id = ?",
+                   [datetime.now(), job_id])
+    write, _, _ = EXPORT_JOB_KINDS[job['kind']]
+    directory = export_job_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{job_id}.xlsx')
+    partial = path + '.part'
+    last_update = [0.0]
+    written = [0]
+
+    def progress(rows, total=None):
+        written[0] = rows
+        now = time.monotonic()
+        if now - last_update[0] < EXPORT_JOB_PROGRESS_INTERVAL:
+            return
+        last_update[0] = now
+        with get_db(write=True) as db:
+            db.execute('UPDATE export_job SET rows_written = ?, rows_total = ?, heartbeat_at = ? WHERE id = ?',
+                       [rows, total, datetime.now(), job_id])
+
+    try:
+        write(partial, json.loads(job['params']), progress)
+        os.replace(partial, path)
+    except Exception as e:
+        app.logger.exception('export job %s failed', job_id)
+        remove_file(partial)
+        with get_db(write=True) as db:
+            fail_export_job(db, job_id, str(e), datetime.now())
+        return
+    finished = datetime.now()
+    with get_db(write=True) as db:
+        # لا نعيد إحياء مهمة عُلّمت كمتوقفة أثناء تنفيذها
+        updated = db.execute('''
+            UPDATE export_job SET status = 'done', rows_written = ?, file_path = ?, finished_at = ?, expires_at = ?
+            WHERE id = ? AND status = 'running'
+        ''', [written[0], path, finished, finished + timedelta(seconds=app.config['EXPORT_JOB_TTL']), job_id]).rowcount
+    if not updated:
+        remove_file(path)
+
+def fail_dead_export_jobs():
+    """عند بدء التشغيل: المهام التي توقفت عمليتها (إيقاف الخادم أو قتل العملية) تُعلَّم كفاشلة."""
+    with get_db(write=True) as db:
+        expired = cleanup_export_jobs(db)
+    remove_export_files(expired)
+
+def export_job_status(job):
+    status = {key: job[key] for key in ('id', 'kind', 'status', 'rows_written', 'rows_total', 'error')}
+    status['status_url'] = url_for('export_job', job_id=job['id'])
+    if job['status'] == 'done':
+        status['download_url'] = url_for('export_job_download', job_id=job['id'])
+    return status
+
+def export_job_response(kind, params):
+    job_id = submit_export_job(kind, params)
+    with get_db() as db:
+        job = db.execute('SELECT * FROM export_job WHERE id = ?', [job_id]).fetchone()
+    return jsonify(export_job_status(job)), 202
+
+def read_export_job(job_id):
+    """
+    قراءة المهمة مع التحقق من حالتها: 404 إن لم توجد، و410 إن انتهت صلاحيتها (ويُحذف ملفها)،
+    والمهمة المتوقفة تُعلَّم كفاشلة قبل إعادتها.
+    """
+    with get_db() as db:
+        job = db.execute('SELECT * FROM export_job WHERE id = ?', [job_id]).fetchone()
+    if job is None:
+        abort(404)
+    now = datetime.now()
+    if job['expires_at'] and job['expires_at'] <= now:
+        with get_db(write=True) as db:
+            db.execute('DELETE FROM export_job WHERE id = ?', [job_id])
+        if job['file_path']:
+            remove_export_files([job['file_path']])
+        abort(410)
+    if job['status'] in ('pending', 'running') and not export_job_alive(job, now):
+        with get_db(write=True) as db:
+            fail_export_job(db, job_id, 'interrupted', now)
+            job = db.execute('SELECT * FROM export_job WHERE id = ?', [job_id]).fetchone()
+    return job
+
+@app.route('/export-jobs/<job_id>')
+def export_job(job_id):
+    return jsonify(export_job_status(read_export_job(job_id)))
+
+@app.route('/export-jobs/<job_id>/download')
+def export_job_download(job_id):
+    job = read_export_job(job_id)
+    if job['status'] != 'done' or not os.path.exists(job['file_path']):
+        abort(404)
+    return send_file(job['file_path'], download_name=EXPORT_JOB_KINDS[job['kind']][1], as_attachment=True,
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+IMPORT_BATCH_SIZE = 1000
+
+def staging_table_name(table, import_id):
+    # اسم خاص بكل عملية استيراد حتى لا تكتب عمليتا استيراد متزامنتان في نفس الجداول
+    return f'{table}__staging_{import_id}'
+
+def create_staging_table(db, table, import_id):
+    """إنشاء نسخة فارغة من الجدول بنفس التعريف والقيود لاستقبال البيانات المستوردة."""
+    sql = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", [table]).fetchone()[0]
+    staging = staging_table_name(table, import_id)
+    db.execute(re.sub(rf'^CREATE TABLE\s+("?){table}\1', f'CREATE TABLE {staging}', sql, count=1))
+
+def drop_staging_tables(tables, import_id):
+    with get_db(write=True) as db:
+        for table in tables:
+            db.execute(f'DROP TABLE IF EXISTS {staging_table_name(table, import_id)}')
+
+def load_sheet(ws, table, import_id):
+    """
+    قراءة ورقة إكسل سطراً بسطر وإدخالها في جدول staging على دفعات (executemany)،
+    كل دفعة في معاملة قصيرة حتى لا يبقى قفل الكتابة محجوزاً طوال الاستيراد.
+    """
+    rows = ws.iter_rows(values_only=True)
+    header_row = next(rows, None)
+    if not header_row:
+        return 0
+    headers = []
+    for header in header_row:
+        if header is None:
+            break
+        headers.append(str(header))
+    with get_db() as db:
+        columns = {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+    unknown = [h for h in headers if h not in columns]
+    if unknown:
+        raise ValueError(f'أعمدة غير معروفة في ورقة {table}: {", ".join(unknown)}')
+    width = len(headers)
+    placeholders = ','.join(['?'] * width)
+    sql = f'INSERT INTO {staging_table_name(table, import_id)} ({",".join(headers)}) VALUES ({placeholders})'
+    count = 0
+    batch = []
+    for data_row in rows:
+        data_row = tuple(data_row[:width])
+        # Skip empty rows
+        if all(cell is None for cell in data_row):
+            continue
+        if len(data_row) < width:
+            data_row += (None,) * (width - len(data_row))
+        batch.append(data_row)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            with get_db(write=True) as db:
+                db.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        with get_db(write=True) as db:
+            db.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+def swap_staging_tables(db, tables, import_id):
+    """
+    استبدال الجداول الحية بجداول staging (حذف ثم إعادة تسمية) داخل معاملة واحدة،
+    ثم إعادة إنشاء الفهارس وفهرس البحث مرة واحدة بدل تحديثها مع كل صف.
+    """
+    for table in tables:
+        db.execute(f'DROP TABLE {table}')
+        db.execute(f'ALTER TABLE {staging_table_name(table, import_id)} RENAME TO {table}')
+    ensure_indexes(db)
+    ensure_search_index(db, rebuild=True)
+    normalize_dates(db)
+    link_shipment_lookups(db)
+    refresh_shipment_totals(db)
+    rebuild_rollup(db)
+    seed_receipt_counters(db)
+    bump_data_version(db, *tables)
+
+def import_workbook(wb):
+    """
+    استيراد كل أوراق الملف إلى جداول staging ثم استبدال الجداول الحية بها دفعة واحدة.
+    يُرفض الاستبدال (ValueError) إذا عُدلت البيانات الحية أثناء التحميل أو وُجدت بنود تشير
+    إلى شحنات أو أصناف غير موجودة، وتبقى البيانات الحالية كما هي.
+    يعيد [(الجدول، عدد الصفوف، الزمن بالثواني)].
+    """
+    import_id = uuid.uuid4().hex[:12]
+    with get_db(write=True) as db:
+        versions = get_data_versions(db, EXPORT_TABLES)
+        for table in EXPORT_TABLES:
+            create_staging_table(db, table, import_id)
+    try:
+        stats = []
+        for table in EXPORT_TABLES:
+            started = time.perf_counter()
+            count = load_sheet(wb[table], table, import_id) if table in wb.sheetnames else 0
+            stats.append((table, count, time.perf_counter() - started))
+        with get_db(write=True) as db:
+            # أي إضافة أو تعديل على الجداول الحية بعد بدء التحميل كانت ستضيع مع الاستبدال
+            if get_data_versions(db, EXPORT_TABLES) != versions:
+                raise ValueError('تغيرت البيانات أثناء الاستيراد (إضافة أو تعديل أو استيراد آخر). أعد المحاولة.')
+            swap_staging_tables(db, EXPORT_TABLES, import_id)
+            # فحص المفاتيح الأجنبية مؤجل إلى نهاية الاستيراد، وأي خطأ يلغي المعاملة كاملة
+            for table in EXPORT_TABLES:
+                broken = db.execute(f'PRAGMA foreign_key_check({table})').fetchall()
+                if broken:
+                    raise ValueError(f'{len(broken)} من صفوف {table} تشير إلى {broken[0][2]} غير موجود '
+                                     f'(أول صف: {broken[0][1]}).')
+    except Exception:
+        drop_staging_tables(EXPORT_TABLES, import_id)
+        raise
+    return stats
 
 @app.route('/import-all', methods=['GET', 'POST'])
 def import_all():
     """
     Import all tables from an uploaded Excel file.
     """
-    if openpyxl is None:
+    try:
+        import openpyxl
+    except ImportError:
         flash('مكتبة openpyxl غير مثبتة. يرجى تثبيتها أولاً (pip install openpyxl).', 'error')
         return redirect(url_for('index'))
     if request.method == 'POST':
@@ -1217,42 +2831,239 @@ def import_all():
         if not file:
             flash('يرجى اختيار ملف إكسل.', 'error')
             return redirect(url_for('import_all'))
-        wb = openpyxl.load_workbook(file)
-        tables = [
-            'shipment', 'shipment_item', 'shipment_type',
-            'department', 'carrier_company', 'governorate'
-        ]
-        with get_db() as db:
-            db.execute('PRAGMA foreign_keys = OFF')
-            # Clear all tables
-            for table in tables:
-                db.execute(f'DELETE FROM {table}')
-            # Import each sheet
-            for table in tables:
-                if table not in wb.sheetnames:
-                    continue
-                ws = wb[table]
-                rows = list(ws.iter_rows(values_only=True))
-                if not rows or len(rows) < 2:
-                    continue
-                headers = [str(h) for h in rows[0]]
-                for data_row in rows[1:]:
-                    # Skip empty rows
-                    if all(cell is None for cell in data_row):
-                        continue
-                    placeholders = ','.join(['?'] * len(headers))
-                    db.execute(
-                        f'INSERT INTO {table} ({",".join(headers)}) VALUES ({placeholders})',
-                        data_row
-                    )
-            db.execute('PRAGMA foreign_keys = ON')
-        flash('تم استيراد جميع البيانات بنجاح.', 'success')
+        wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            stats = import_workbook(wb)
+        except (ValueError, sqlite3.IntegrityError) as e:
+            flash(f'فشل الاستيراد ولم تتغير البيانات الحالية: {e}', 'error')
+            return redirect(url_for('import_all'))
+        finally:
+            wb.close()
+        summary = '، '.join(f'{table}: {count} ({elapsed:.2f} ث)' for table, count, elapsed in stats)
+        flash(f'تم استيراد جميع البيانات بنجاح. {summary}', 'success')
         return redirect(url_for('index'))
     return render_template('import_all.html')
 
-# Initialize the database when the app starts
-with app.app_context():
-    init_db()
+# حدود فئات مدرج زمن الاستجابة بالملي ثانية (الفئة الأخيرة لما فوق آخر حد)
+PERF_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+PERF_SAMPLES = 1000  # آخر عدد من الأزمنة المحفوظة لكل مسار لحساب النسب المئوية
+PERF_QUERIES_PER_ROUTE = 50  # أقصى عدد من الاستعلامات المختلفة المسجلة لكل مسار، والباقي يُجمع في سطر واحد
+PERF_TOP_QUERIES = 30  # عدد الاستعلامات الأبطأ (حسب الزمن الكلي) المعروضة في اللوحة
+
+def perf_query_key(sql):
+    """نص الاستعلام بمسافات موحدة ليُجمع تنفيذ نفس الاستعلام تحت مفتاح واحد."""
+    return ' '.join(sql.split())
+
+class PerfStats:
+    """إحصائيات الأداء المجمعة لكل مسار (endpoint + method) منذ بدء التشغيل أو آخر تصفير."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+            self.since = datetime.now()
+
+    def record(self, route, elapsed, perf, size):
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0, 'queries': 0, 'statements': 0,
+                    'query_time': 0.0, 'template_time': 0.0, 'bytes': 0,
+                    'buckets': [0] * (len(PERF_BUCKETS_MS) + 1),
+                    'samples': deque(maxlen=PERF_SAMPLES),
+                    'sql': {},  # نص الاستعلام -> [عدد التنفيذ، الزمن الكلي، الأقصى]
+                }
+            elapsed_ms = elapsed * 1000
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['queries'] += perf['queries']
+            stats['statements'] += perf['statements']
+            stats['query_time'] += perf['query_time']
+            stats['template_time'] += perf['template_time']
+            stats['bytes'] += size
+            stats['buckets'][next((i for i, bound in enumerate(PERF_BUCKETS_MS) if elapsed_ms <= bound),
+                                  len(PERF_BUCKETS_MS))] += 1
+            stats['samples'].append(elapsed_ms)
+            for sql, query_time in perf['query_log']:
+                key = perf_query_key(sql)
+                if key not in stats['sql'] and len(stats['sql']) >= PERF_QUERIES_PER_ROUTE:
+                    key = '(other queries)'
+                query = stats['sql'].setdefault(key, [0, 0.0, 0.0])
+                query[0] += 1
+                query[1] += query_time
+                query[2] = max(query[2], query_time)
+
+    def snapshot(self):
+        """الإحصائيات بالملي ثانية كقاموس قابل للتحويل إلى JSON، مرتبة حسب الزمن الكلي."""
+        with self._lock:
+            routes = {route: dict(stats, samples=sorted(stats['samples']),
+                                  sql={key: list(query) for key, query in stats['sql'].items()})
+                      for route, stats in self.routes.items()}
+            since = self.since
+        queries = sorted(((route, sql, query) for route, stats in routes.items()
+                          for sql, query in stats['sql'].items()), key=lambda item: -item[2][1])
+        result = []
+        for route, stats in sorted(routes.items(), key=lambda item: -item[1]['total']):
+            count = stats['count']
+            samples = stats['samples']
+
+            def percentile(p):
+                return round(samples[min(len(samples) - 1, int(len(samples) * p))], 1) if samples else 0
+            result.append({
+                'route': route,
+                'count': count,
+                'avg_ms': round(stats['total'] * 1000 / count, 1),
+                'p50_ms': percentile(0.50),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': round(stats['max'] * 1000, 1),
+                'avg_queries': round(stats['queries'] / count, 1),
+                'avg_statements': round(stats['statements'] / count, 1),
+                'avg_query_ms': round(stats['query_time'] * 1000 / count, 1),
+                'avg_template_ms': round(stats['template_time'] * 1000 / count, 1),
+                'avg_bytes': stats['bytes'] // count,
+                'buckets': stats['buckets'],
+            })
+        return {
+            'enabled': app.config['PERF_INSTRUMENTATION'],
+            'since': since.strftime(DATETIME_FORMAT),
+            'buckets_ms': list(PERF_BUCKETS_MS),
+            'routes': result,
+            'queries': [{
+                'route': route,
+                'sql': sql,
+                'count': count,
+                'avg_ms': round(total * 1000 / count, 2),
+                'max_ms': round(slowest * 1000, 2),
+                'total_ms': round(total * 1000, 1),
+            } for route, sql, (count, total, slowest) in queries[:PERF_TOP_QUERIES]],
+            'report_cache': report_cache.stats(),
+        }
+
+perf_stats = PerfStats()
+
+@app.before_request
+def _perf_start():
+    if app.config['PERF_INSTRUMENTATION']:
+        g.perf = {'started': time.perf_counter(), 'queries': 0, 'statements': 0,
+                  'query_time': 0.0, 'template_time': 0.0, 'query_log': [], 'size': 0}
+
+@app.after_request
+def _perf_response_size(response):
+    perf = perf_request()
+    if perf is not None:
+        # حجم الاستجابات المتدفقة غير معروف مسبقاً فيُسجل صفراً
+        perf['size'] = response.content_length or 0
+    return response
+
+@app.teardown_request
+def _perf_finish(exc):
+    # يُسجل عند انتهاء الطلب، وللاستجابات المتدفقة (perf_stream) بعد انتهاء التدفق حتى يُحسب زمن
+    # جلب الصفوف فيها
+    perf = perf_request()
+    endpoint = request.endpoint
+    if perf is not None and not perf.get('streaming') and endpoint and not endpoint.startswith('debug_perf'):
+        perf_stats.record(f'{request.method} {endpoint}', time.perf_counter() - perf['started'], perf, perf['size'])
+
+def perf_stream(generator):
+    """stream_with_context مع تأجيل تسجيل قياس الطلب إلى نهاية التدفق."""
+    perf = perf_request()
+    if perf is not None:
+        perf['streaming'] = True
+
+    def run():
+        try:
+            yield from generator
+        finally:
+            if perf is not None:
+                perf['streaming'] = False
+    return stream_with_context(run())
+
+def _perf_template_started(sender, template, context, **extra):
+    perf = perf_request()
+    if perf is not None:
+        perf.setdefault('template_started', []).append(time.perf_counter())
+
+def _perf_template_finished(sender, template, context, **extra):
+    perf = perf_request()
+    if perf is not None and perf.get('template_started'):
+        perf['template_time'] += time.perf_counter() - perf['template_started'].pop()
+
+before_render_template.connect(_perf_template_started, app)
+template_rendered.connect(_perf_template_finished, app)
+
+def _require_local_perf():
+    # لوحة القياس متاحة فقط عند تفعيلها ومن نفس الجهاز
+    if not app.config['PERF_INSTRUMENTATION'] or request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+@app.route('/debug/perf')
+def debug_perf():
+    _require_local_perf()
+    return render_template('debug_perf.html', perf=perf_stats.snapshot())
+
+@app.route('/debug/perf.json')
+def debug_perf_json():
+    _require_local_perf()
+    return jsonify(perf_stats.snapshot())
+
+@app.route('/debug/perf/reset', methods=['POST'])
+def debug_perf_reset():
+    _require_local_perf()
+    perf_stats.reset()
+    report_cache.reset_stats()
+    return redirect(url_for('debug_perf'))
+
+startup_mark('app setup')
+
+# تهيئة قاعدة البيانات مؤجلة إلى أول طلب (أو بدء التشغيل المباشر) بدل وقت استيراد الوحدة،
+# حتى لا تدفع السكربتات التي تستورد app (init_db.py، bench_storage.py...) ثمنها
+_db_ready = False
+_db_ready_lock = threading.Lock()
+
+def ensure_db_ready():
+    global _db_ready
+    if _db_ready:
+        return
+    with _db_ready_lock:
+        if not _db_ready:
+            init_db()
+            fail_dead_export_jobs()
+            _db_ready = True
+
+@app.before_request
+def _init_db_before_request():
+    ensure_db_ready()
+
+def startup_report():
+    """طباعة أزمنة مراحل بدء التشغيل حتى عرض الصفحة الأولى (للتفصيل: python -X importtime app.py)."""
+    started = time.perf_counter()
+    ensure_db_ready()
+    STARTUP_TIMINGS.append(('init_db', time.perf_counter() - started))
+    started = time.perf_counter()
+    with app.test_client() as client:
+        status = client.get('/').status_code
+    STARTUP_TIMINGS.append((f'first request / ({status})', time.perf_counter() - started))
+    for module in ('xlsxwriter', 'openpyxl'):
+        started = time.perf_counter()
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        STARTUP_TIMINGS.append((f'import {module} (lazy)', time.perf_counter() - started))
+    for phase, seconds in STARTUP_TIMINGS:
+        print(f'{phase:<32}{seconds * 1000:>10.1f} ms')
+    print(f"{'total before first page':<32}{sum(t for p, t in STARTUP_TIMINGS if 'lazy' not in p) * 1000:>10.1f} ms")
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    if '--startup-report' in sys.argv:
+        startup_report()
+    else:
+        # خادم التطوير فقط (خيط واحد)؛ للتشغيل الفعلي استخدم serve.py
+        ensure_db_ready()
+        app.run(debug=True)
\ No newline at end of file
@@ -3,7 +3,7 @@
 block_cipher = None
 
 a = Analysis(
-    ['app.py'],
+    ['serve.py'],  # خادم الإنتاج (waitress على ويندوز)؛ app.py للتطوير فقط
     pathex=['d:\\Jibal\\New'],
     binaries=[],
     datas=[
@@ -11,7 +11,7 @@ a = Analysis(
         ('static', 'static'),
         ('shipping.db', '.'),
     ],
-    hiddenimports=['sqlite3', 'flask', 'openpyxl', 'xlsxwriter'],
+    hiddenimports=['sqlite3', 'flask', 'openpyxl', 'xlsxwriter', 'waitress'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,260 @@
+"""
+قياس أداء صفحات التطبيق: إنشاء قاعدة بيانات تجريبية بالحجم المطلوب ثم تنفيذ طلبات متكررة
+عبر Flask test client على أهم المسارات، وطباعة p50/p95/p99 والإنتاجية وأقصى ذاكرة مستخدمة.
+النتائج تُحفظ بصيغة JSON للمقارنة بين النسخ.
+
+الاستخدام:
+    python bench_routes.py --shipments 20000 --items 3 --output before.json
+    python bench_routes.py --shipments 20000 --items 3 --output after.json --compare before.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import app as shipping_app
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# المسارات المقاسة: (الاسم، عدد التكرارات كنسبة من --iterations)
+ROUTES = (
+    ('index', 1.0),
+    ('index_search', 1.0),
+    ('view_shipment', 1.0),
+    ('new_shipment', 1.0),
+    ('api_generate_shopiny_number', 1.0),
+    ('reports_monthly', 0.5),
+    ('reports_by', 0.5),
+    ('export_all', 0.1),
+    ('import_all', 0.1),
+)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # كيلوبايت على لينكس وبايت على macOS
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+def generate_db(path, shipments, items, governorates, carriers, seed):
+    """إنشاء قاعدة بيانات تجريبية بالحجم المطلوب عبر نفس مخطط التطبيق وترحيلاته."""
+    rng = random.Random(seed)
+    shipping_app.app.config['DATABASE'] = path
+    shipping_app.reset_pool()
+    shipping_app.init_db()
+    gov_names = [f'G{i:02d}' for i in range(governorates)]
+    carrier_names = [f'Carrier{i}' for i in range(carriers)]
+    start = datetime(2024, 1, 1)
+    with shipping_app.get_db(write=True) as db:
+        db.executemany('INSERT INTO governorate (name) VALUES (?)', [(name,) for name in gov_names])
+        db.executemany('INSERT INTO carrier_company (name) VALUES (?)', [(name,) for name in carrier_names])
+        db.executemany('INSERT INTO shipment_type (name) VALUES (?)', [(f'صنف {i}',) for i in range(5)])
+        db.executemany('INSERT INTO department (name) VALUES (?)', [(f'قسم {i}',) for i in range(4)])
+        shipment_rows = []
+        item_rows = []
+        for i in range(1, shipments + 1):
+            delivery = start + timedelta(days=rng.randrange(730))
+            source = rng.choice(gov_names)
+            shipment_rows.append((
+                i, f'SH{i:08d}', f'{source}{delivery:%y%m}{i:06d}', f'O{i}', delivery,
+                source, rng.choice(gov_names), rng.choice(carrier_names), '',
+                delivery + timedelta(hours=rng.randrange(48)),
+            ))
+            for _ in range(items):
+                quantity, cost, boxes = rng.randint(1, 50), rng.randint(1, 100) * 250, rng.randint(1, 10)
+                use_boxes = rng.random() < 0.3
+                item_rows.append((i, rng.randint(1, 5), rng.randint(1, 4), quantity, cost, boxes,
+                                  (boxes if use_boxes else quantity) * cost, '', int(use_boxes)))
+        db.executemany('''
+            INSERT INTO shipment (id, shopiny_number, receipt_number, order_number, delivery_date,
+                                  from_governorate, to_governorate, carrier_company, notes, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', shipment_rows)
+        db.executemany('''
+            INSERT INTO shipment_item (shipment_id, shipment_type_id, department_id, quantity, cost,
+                                       boxes_count, total, notes, use_boxes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', item_rows)
+        shipping_app.link_shipment_lookups(db)
+        shipping_app.refresh_shipment_totals(db)
+        shipping_app.rebuild_rollup(db)
+        shipping_app.seed_receipt_counters(db)
+        db.execute('ANALYZE')
+    shipping_app.reset_pool()
+    return gov_names, carrier_names
+
+class RouteRunner:
+    """يبني طلب كل مسار مقاس. كل دالة تعيد الاستجابة بعد قراءة جسمها كاملاً."""
+
+    def __init__(self, client, shipments, gov_names, carrier_names, seed):
+        self.client = client
+        self.shipments = shipments
+        self.gov_names = gov_names
+        self.carrier_names = carrier_names
+        self.rng = random.Random(seed)
+        self.counter = 0
+        self.workbook = None
+
+    def index(self):
+        return self.client.get('/?from_governorate=' + self.rng.choice(self.gov_names))
+
+    def index_search(self):
+        return self.client.get(f'/?filter_field=all&filter_value=SH{self.rng.randint(1, self.shipments):08d}')
+
+    def view_shipment(self):
+        return self.client.get(f'/shipment/{self.rng.randint(1, self.shipments)}')
+
+    def new_shipment(self):
+        self.counter += 1
+        return self.client.post('/shipment/new', data={
+            'shopiny_number': f'BENCH{os.getpid()}-{self.counter}',
+            'receipt_number': f'BENCH{os.getpid()}-{self.counter}',
+            'order_number': 'bench',
+            'delivery_date': '2025-06-15',
+            'source_governorate': self.rng.choice(self.gov_names),
+            'destination_governorate': self.rng.choice(self.gov_names),
+            'carrier_company': self.rng.choice(self.carrier_names),
+            'items[0][shipment_type_id]': '1',
+            'items[0][department_id]': '1',
+            'items[0][quantity]': '3',
+            'items[0][cost]': '1000',
+            'items[0][boxes_count]': '1',
+        })
+
+    def api_generate_shopiny_number(self):
+        return self.client.get('/api/generate_shopiny_number', query_string={
+            'governorate': self.rng.choice(self.gov_names), 'delivery_date': '2025-06-15'})
+
+    def reports_monthly(self):
+        month = self.rng.randint(1, 12)
+        return self.client.post('/reports/monthly', data={
+            'from_date': f'2024-{month:02d}-01', 'to_date': f'2024-{month:02d}-28'})
+
+    def reports_by(self):
+        return self.client.post('/reports/by', data={
+            'from_date': '2024-01-01', 'to_date': '2024-03-31',
+            'carrier_company': self.rng.choice(self.carrier_names)})
+
+    def export_all(self):
+        response = self.client.get('/export-all')
+        self.workbook = response.data
+        return response
+
+    def import_all(self):
+        if self.workbook is None:
+            self.export_all()
+        return self.client.post('/import-all', content_type='multipart/form-data', data={
+            'import_file': (io.BytesIO(self.workbook), 'bench.xlsx')})
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def run_route(runner, name, iterations):
+    call = getattr(runner, name)
+    call().get_data()  # تسخين (تحميل القوالب والمكتبات والذاكرة المؤقتة)
+    samples = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        response = call()
+        response.get_data()
+        samples.append((time.perf_counter() - t) * 1000)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    samples.sort()
+    return {
+        'count': iterations,
+        'errors': errors,
+        'mean_ms': round(sum(samples) / len(samples), 2),
+        'p50_ms': round(percentile(samples, 0.50), 2),
+        'p95_ms': round(percentile(samples, 0.95), 2),
+        'p99_ms': round(percentile(samples, 0.99), 2),
+        'max_ms': round(samples[-1], 2),
+        'rps': round(iterations / elapsed, 1),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_results(results, baseline=None):
+    header = f"{'route':<30}{'p50':>9}{'p95':>9}{'p99':>9}{'req/s':>9}{'rss MB':>9}"
+    if baseline:
+        header += f"{'p50 vs base':>13}"
+    print(header)
+    for name, stats in results['routes'].items():
+        line = (f"{name:<30}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+                f"{stats['rps']:>9.1f}{stats['peak_rss_mb'] or 0:>9.1f}")
+        base = baseline and baseline['routes'].get(name)
+        if base:
+            line += f"{stats['p50_ms'] / base['p50_ms']:>12.2f}x" if base['p50_ms'] else f"{'-':>13}"
+        if stats['errors']:
+            line += f"  ({stats['errors']} errors)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask route benchmark on a synthetic database')
+    parser.add_argument('--shipments', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=3, help='items per shipment')
+    parser.add_argument('--governorates', type=int, default=18)
+    parser.add_argument('--carriers', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--routes', nargs='*', choices=[name for name, _ in ROUTES],
+                        help='routes to run (default: all)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_routes_')
+    try:
+        path = os.path.join(workdir, 'shipping.db')
+        started = time.perf_counter()
+        gov_names, carrier_names = generate_db(path, args.shipments, args.items, args.governorates,
+                                               args.carriers, args.seed)
+        print(f'generated {args.shipments} shipments x {args.items} items in {time.perf_counter() - started:.1f}s')
+        shipping_app.app.config['DATABASE'] = path
+        shipping_app.reset_pool()
+        runner = RouteRunner(shipping_app.app.test_client(), args.shipments, gov_names, carrier_names, args.seed)
+        results = {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            'routes': {},
+        }
+        for name, share in ROUTES:
+            if args.routes and name not in args.routes:
+                continue
+            results['routes'][name] = run_route(runner, name, max(1, int(args.iterations * share)))
+        shipping_app.reset_pool()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+قياس أداء إعدادات التخزين: قراءة وكتابة متزامنة من عدة عملاء على نسخة مؤقتة
+من قاعدة البيانات: بالإعدادات الافتراضية لـ SQLite، ثم بإعدادات WAL مع BEGIN IMMEDIATE،
+ثم بنفس الإعدادات مع طابور الكتابة (DB_SERIALIZE_WRITES).
+
+الاستخدام:
+    python bench_storage.py --readers 8 --writers 4 --seconds 5
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import app as shipping_app
+
+PROFILES = {
+    # إعدادات SQLite الافتراضية كما كان التطبيق يعمل سابقاً
+    'default': ({'busy_timeout': 5000}, False),
+    # WAL مع BEGIN IMMEDIATE و busy_timeout فقط، وSQLite يرتب الكتّاب بقفله
+    'wal': (shipping_app.app.config['SQLITE_PRAGMAS'], False),
+    # نفس الإعدادات مع طابور الكتابة داخل العملية
+    'wal+queue': (shipping_app.app.config['SQLITE_PRAGMAS'], True),
+}
+
+def seed(path, shipments):
+    shipping_app.app.config['DATABASE'] = path
+    shipping_app.app.config['SQLITE_PRAGMAS'] = {}
+    shipping_app.reset_pool()
+    shipping_app.init_db()
+    with shipping_app.get_db(write=True) as db:
+        db.executemany('INSERT INTO governorate (name) VALUES (?)', [('BSR',), ('BGD',), ('MYN',)])
+        db.executemany('INSERT INTO shipment_type (name) VALUES (?)', [('طرد',)])
+        db.executemany('INSERT INTO department (name) VALUES (?)', [('المخزن',)])
+        db.executemany('''
+            INSERT INTO shipment (shopiny_number, receipt_number, order_number, delivery_date,
+                                  from_governorate, to_governorate, carrier_company)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(f'S{i}', f'R{i}', f'O{i}', f'2025-{i % 12 + 1:02d}-01 00:00:00', 'BSR', 'MYN', 'Shopini')
+              for i in range(shipments)])
+    shipping_app.reset_pool()
+
+def run_profile(path, profile, readers, writers, seconds):
+    pragmas, serialize = PROFILES[profile]
+    shipping_app.app.config['DATABASE'] = path
+    shipping_app.app.config['SQLITE_PRAGMAS'] = pragmas
+    shipping_app.app.config['DB_SERIALIZE_WRITES'] = serialize
+    shipping_app.app.config['DB_POOL_SIZE'] = readers + writers
+    shipping_app.reset_pool()
+    stats = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def reader():
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            try:
+                with shipping_app.get_db() as db:
+                    db.execute('SELECT COUNT(*), MAX(delivery_date) FROM shipment WHERE from_governorate = ?',
+                               ['BSR']).fetchone()
+                done += 1
+            except sqlite3.OperationalError:
+                errors += 1
+        with lock:
+            stats['reads'] += done
+            stats['errors'] += errors
+
+    def writer(n):
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            try:
+                with shipping_app.get_db(write=True) as db:
+                    cursor = db.execute('''
+                        INSERT INTO shipment (shopiny_number, receipt_number, delivery_date,
+                                              from_governorate, to_governorate, carrier_company)
+                        VALUES (?, ?, ?, 'BSR', 'MYN', 'Shopini')
+                    ''', [f'{profile}-{n}-{done}', f'{profile}-{n}-{done}', '2025-06-01 00:00:00'])
+                    db.execute('''
+                        INSERT INTO shipment_item (shipment_id, shipment_type_id, department_id,
+                                                   quantity, cost, boxes_count, total)
+                        VALUES (?, 1, 1, 1, 1000, 1, 1000)
+                    ''', [cursor.lastrowid])
+                done += 1
+            except sqlite3.OperationalError:
+                errors += 1
+        with lock:
+            stats['writes'] += done
+            stats['errors'] += errors
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    shipping_app.reset_pool()
+    return {
+        'reads_per_sec': stats['reads'] / elapsed,
+        'writes_per_sec': stats['writes'] / elapsed,
+        'errors': stats['errors'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite storage profile benchmark')
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--shipments', type=int, default=20000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_storage_')
+    try:
+        template = os.path.join(workdir, 'template.db')
+        seed(template, args.shipments)
+        print(f'{args.readers} readers, {args.writers} writers, {args.seconds}s per profile')
+        print(f"{'profile':<10}{'reads/s':>12}{'writes/s':>12}{'errors':>10}")
+        for profile in PROFILES:
+            path = os.path.join(workdir, f'{profile}.db')
+            shutil.copyfile(template, path)
+            result = run_profile(path, profile, args.readers, args.writers, args.seconds)
+            print(f"{profile:<10}{result['reads_per_sec']:>12.0f}{result['writes_per_sec']:>12.0f}{result['errors']:>10}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
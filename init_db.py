@@ -1,7 +1,9 @@
 import sqlite3
-from app import DATABASE
+from app import DATABASE, init_db
 
 def init_sample_data():
+    # استيراد app لم يعد ينشئ الجداول، لذلك نتأكد من المخطط أولاً
+    init_db()
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
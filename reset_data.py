@@ -1,6 +1,8 @@
 import sqlite3
 
 DB_PATH = 'shipping.db'
+# مجاميع التقرير الشهري المحسوبة مسبقاً وآخر رقم وصل لكل (محافظة، شهر)
+DERIVED_TABLES = ['monthly_rollup', 'receipt_counter']
 
 def reset_all_data():
     tables = [
@@ -12,6 +14,22 @@ def reset_all_data():
         conn.execute('PRAGMA foreign_keys = OFF')
         for table in tables:
             conn.execute(f'DELETE FROM {table}')
+        # الجداول المشتقة من الشحنات (قد لا توجد في قاعدة بيانات لم تُرحَّل بعد)
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        derived = [table for table in DERIVED_TABLES if table in existing]
+        for table in derived:
+            conn.execute(f'DELETE FROM {table}')
+        # إبلاغ نسخ التطبيق العاملة بأن القوائم المخزنة في الذاكرة لم تعد صالحة
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS data_version (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.executemany('''
+            INSERT INTO data_version (name, version) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1
+        ''', [(table,) for table in tables + derived])
         conn.execute('PRAGMA foreign_keys = ON')
         conn.commit()
         print('تم تصفير جميع البيانات بنجاح.')
@@ -0,0 +1,100 @@
+"""
+تشغيل التطبيق على خادم إنتاج متعدد العمليات/الخيوط بدل خادم Flask التطويري.
+
+- لينكس/macOS: gunicorn بعدة عمليات (workers) وعدة خيوط لكل عملية. تهيئة قاعدة البيانات
+  تتم مرة واحدة في العملية الرئيسية قبل إنشاء العمليات الفرعية، وكل عملية تفتح اتصالاتها
+  الخاصة. إعادة التشغيل الهادئة: kill -HUP <pid العملية الرئيسية>.
+- ويندوز (نسخة الفروع المبنية بـ PyInstaller): waitress بعملية واحدة وعدة خيوط.
+
+الإعدادات من app.config (SERVER_*) أو متغيرات البيئة SHIPPING_*، ويمكن تجاوزها من سطر الأوامر:
+    python serve.py --port 8000 --workers 4 --threads 8
+"""
+import argparse
+import os
+import sys
+
+import app as shipping_app
+
+def prepare_database():
+    """تهيئة قاعدة البيانات (الترحيلات والفهارس) مرة واحدة قبل بدء الخادم."""
+    shipping_app.ensure_db_ready()
+    # لا نورّث اتصالات SQLite مفتوحة للعمليات الفرعية
+    shipping_app.reset_pool()
+
+def _post_fork(server, worker):
+    # كل عملية فرعية تبني مجمّع اتصالاتها الخاص عند أول طلب
+    shipping_app.reset_pool()
+
+def run_gunicorn(config):
+    from gunicorn.app.base import BaseApplication
+
+    options = {
+        'bind': f"{config['SERVER_HOST']}:{config['SERVER_PORT']}",
+        'workers': config['SERVER_WORKERS'],
+        'threads': config['SERVER_THREADS'],
+        'worker_class': 'gthread',
+        'keepalive': config['SERVER_KEEPALIVE'],
+        'timeout': config['SERVER_TIMEOUT'],
+        'graceful_timeout': config['SERVER_GRACEFUL_TIMEOUT'],
+        'max_requests': config['SERVER_MAX_REQUESTS'],
+        'max_requests_jitter': config['SERVER_MAX_REQUESTS'] // 10,
+        # تحميل التطبيق في العملية الرئيسية مرة واحدة ثم مشاركته مع العمليات الفرعية
+        'preload_app': True,
+        'post_fork': _post_fork,
+    }
+
+    class ShippingApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return shipping_app.app
+
+    ShippingApplication().run()
+
+def run_waitress(config):
+    from waitress import serve
+
+    # waitress يعمل بعملية واحدة، لذلك مجموع الخيوط = العمليات × الخيوط
+    threads = config['SERVER_WORKERS'] * config['SERVER_THREADS']
+    print(f"waitress: http://{config['SERVER_HOST']}:{config['SERVER_PORT']} ({threads} threads)")
+    # channel_timeout يغلق الاتصالات الخاملة فقط ولا يقطع طلباً جارياً؛ لا يدعم waitress مهلة للطلب
+    serve(shipping_app.app, host=config['SERVER_HOST'], port=config['SERVER_PORT'], threads=threads,
+          channel_timeout=max(config['SERVER_KEEPALIVE'], 1), connection_limit=max(100, threads * 4),
+          ident='shipping')
+
+def main():
+    config = shipping_app.app.config
+    parser = argparse.ArgumentParser(description='Production server for the shipping app')
+    parser.add_argument('--server', choices=['auto', 'gunicorn', 'waitress'], default='auto')
+    parser.add_argument('--host', default=config['SERVER_HOST'])
+    parser.add_argument('--port', type=int, default=config['SERVER_PORT'])
+    parser.add_argument('--workers', type=int, default=config['SERVER_WORKERS'])
+    parser.add_argument('--threads', type=int, default=config['SERVER_THREADS'])
+    parser.add_argument('--timeout', type=int, default=config['SERVER_TIMEOUT'])
+    args = parser.parse_args()
+
+    config['SERVER_HOST'] = args.host
+    config['SERVER_PORT'] = args.port
+    config['SERVER_WORKERS'] = max(1, args.workers)
+    config['SERVER_THREADS'] = max(1, args.threads)
+    config['SERVER_TIMEOUT'] = args.timeout
+    # المجمّع يحتفظ باتصال خامل لكل خيط حتى لا يُفتح اتصال جديد مع كل طلب
+    config['DB_POOL_SIZE'] = max(config['DB_POOL_SIZE'], config['SERVER_THREADS'])
+
+    server = args.server
+    if server == 'auto':
+        server = 'waitress' if os.name == 'nt' else 'gunicorn'
+    try:
+        __import__(server)
+    except ImportError:
+        sys.exit(f'{server} غير مثبت. ثبّته عبر: pip install {server}')
+    prepare_database()
+    if server == 'gunicorn':
+        run_gunicorn(config)
+    else:
+        run_waitress(config)
+
+if __name__ == '__main__':
+    main()